@@ -0,0 +1,36 @@
+'''
+Latency of the paginated listings as the questions table grows.
+
+    python -m benchmarks.bench_pagination [size ...]
+
+With LIMIT/OFFSET pages and a COUNT the first page should stay flat,
+keyset pages (`after_id`) should stay flat at any depth.
+'''
+import sys
+
+from benchmarks.common import create_bench_app, seed_questions, measure
+
+SIZES = [1000, 10000, 100000]
+
+
+def main(sizes):
+    # without the read cache, to measure the queries
+    app = create_bench_app(config={'READ_CACHE_MAX': 0})
+    client = app.test_client()
+    print('{:>10} {:>12} {:>12} {:>12} {:>12}'.format(
+        'rows', 'page=1', 'category', 'deep page', 'after_id'))
+    for size in sizes:
+        seed_questions(app, size)
+        deep_page = size // 20
+        print('{:>10} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+            size,
+            measure(lambda: client.get('/questions?page=1')),
+            measure(lambda: client.get('/categories/3/questions')),
+            measure(lambda: client.get(
+                '/questions?page={}'.format(deep_page))),
+            measure(lambda: client.get(
+                '/questions?after_id={}'.format(deep_page * 10)))))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or SIZES)
@@ -0,0 +1,58 @@
+'''
+Bytes on the wire and encode cost of a page of questions.
+
+    python -m benchmarks.bench_payload [page size ...]
+
+For every page size it encodes the GET /questions payload as a list of
+objects and as columns (`?format=columnar`), without compression, with
+gzip and with brotli (when it's installed), and prints the size and the
+median time to encode and compress it.
+'''
+import json
+import sys
+
+from benchmarks.common import create_bench_app, seed_questions, measure
+from flaskr.compression import brotli, compress
+from flaskr.serialization import FastJSONEncoder, question_rows, \
+    format_rows, columnar
+from models import Question
+
+PAGE_SIZES = [10, 100, 1000]
+
+
+def encodings(app):
+    yield 'identity', None
+    yield 'gzip', app.config.get('COMPRESS_GZIP_LEVEL', 6)
+    if brotli is not None:
+        yield 'br', app.config.get('COMPRESS_BROTLI_QUALITY', 4)
+
+
+def main(sizes):
+    app = create_bench_app()
+    seed_questions(app, max(sizes))
+    print('{:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'size', 'format', 'encoding', 'bytes', 'ms'))
+    with app.app_context():
+        for size in sizes:
+            questions = format_rows(question_rows(Question.query).order_by(
+                Question.id).limit(size))
+            for name, shape in (('objects', lambda: questions),
+                                ('columnar', lambda: columnar(questions))):
+                def encode():
+                    return json.dumps({'success': True,
+                                       'questions': shape()},
+                                      cls=FastJSONEncoder).encode()
+
+                for encoding, level in encodings(app):
+                    def send():
+                        data = encode()
+                        if level is None:
+                            return data
+                        return compress(data, encoding, level)
+
+                    print('{:>8} {:>10} {:>10} {:>10} {:>10.3f}'.format(
+                        size, name, encoding, len(send()), measure(send)))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or PAGE_SIZES)
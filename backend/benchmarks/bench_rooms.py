@@ -0,0 +1,71 @@
+'''
+Cost of a quiz round for a room of players.
+
+    python -m benchmarks.bench_rooms [players ...]
+
+Compares every player drawing their own question with POST /quizzes to
+one POST /rooms/<room>/next whose event is queued for every player of
+the room, and prints the milliseconds and the SQL queries of a round.
+'''
+import sys
+
+from sqlalchemy import event
+
+from benchmarks.common import create_bench_app, seed_questions, measure
+from models import db
+
+PLAYERS = [10, 200, 1000]
+QUESTIONS = 10000
+
+
+def count_queries(app, call):
+    queries = []
+    with app.app_context():
+        engine = db.get_engine()
+
+    def count(*args):
+        queries.append(1)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        call()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return len(queries)
+
+
+def main(sizes):
+    app = create_bench_app(config={'RATE_LIMITS': {'play_quiz': None,
+                                                   'open_room': None}})
+    seed_questions(app, QUESTIONS)
+    client = app.test_client()
+    broadcaster = app.extensions['rooms'].broadcaster
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'players', 'polling ms', 'room ms', 'polling sql', 'room sql'))
+    for players in sizes:
+        room = client.post('/rooms', json={
+            'quiz_category': {'id': 1}}).get_json()
+        listeners = [broadcaster.listen(room['room'])
+                     for _ in range(players)]
+
+        def polling():
+            for _ in range(players):
+                client.post('/quizzes', json={'quiz_category': {'id': 1},
+                                              'previous_questions': []})
+
+        def room_round():
+            client.post('/rooms/{}/next'.format(room['room']),
+                        json={'host_key': room['host_key']})
+            for listener in listeners:
+                while not listener.empty():
+                    listener.get_nowait()
+
+        results = [measure(polling, repeat=5), measure(room_round, repeat=5),
+                   count_queries(app, polling), count_queries(app, room_round)]
+        print('{:>8} {:>12.2f} {:>12.2f} {:>12} {:>12}'.format(
+            players, *results))
+        client.post('/rooms/{}/close'.format(room['room']),
+                    json={'host_key': room['host_key']})
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or PLAYERS)
@@ -0,0 +1,45 @@
+'''
+Latency of the searchTerm path, ILIKE scan against the search index.
+
+    python -m benchmarks.bench_search [size ...]
+
+On postgres the index is the GIN index of migration 3f6a1c9d2b7e, run
+`flask db upgrade` on the benchmark database first. On sqlite it is the
+in-memory inverted index.
+'''
+import sys
+
+from benchmarks.common import create_bench_app, seed_questions, measure
+from models import Question
+
+SIZES = [10000, 100000, 1000000]
+TERMS = ['win', 'largest lake', 'paint']
+
+
+def ilike_search(term):
+    # the previous implementation: one page plus the total of an ILIKE scan
+    matches = Question.query.filter(Question.question.ilike(f'%{term}%'))
+    return matches.order_by(Question.id).limit(10).all(), matches.count()
+
+
+def main(sizes):
+    app = create_bench_app()
+    search = app.extensions['question_search']
+    print('{:>10} {:>14} {:>12} {:>12}'.format(
+        'rows', 'term', 'ilike', 'index'))
+    for size in sizes:
+        seed_questions(app, size)
+        with app.app_context():
+            # drop the backend of the previous size so an in-memory index
+            # is built again before timing
+            search.backend = None
+            search.search(TERMS[0])
+            for term in TERMS:
+                ilike = measure(lambda: ilike_search(term))
+                index = measure(lambda: search.search(term))
+                print('{:>10} {:>14} {:>12.2f} {:>12.2f}'.format(
+                    size, term, ilike, index))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or SIZES)
@@ -0,0 +1,62 @@
+'''
+CPU time and memory of building and encoding a page of questions.
+
+    python -m benchmarks.bench_serialization [page size ...]
+
+Compares Question instances with Question.format() and the standard
+library encoder to the rows of question_rows() with the jsonify encoder
+(orjson when it's installed).
+'''
+import json
+import sys
+import tracemalloc
+
+from benchmarks.common import create_bench_app, seed_questions, measure
+from flaskr.serialization import FastJSONEncoder, question_rows, \
+    format_rows, orjson
+from models import db, Question
+
+PAGE_SIZES = [10, 100, 1000]
+
+
+def orm_page(size):
+    questions = Question.query.order_by(Question.id).limit(size).all()
+    return json.dumps([question.format() for question in questions])
+
+
+def row_page(size):
+    rows = question_rows(Question.query).order_by(Question.id).limit(
+        size).all()
+    return json.dumps(format_rows(rows), cls=FastJSONEncoder)
+
+
+def peak_memory(call):
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def main(sizes):
+    app = create_bench_app()
+    seed_questions(app, max(sizes))
+    print('encoder: {}'.format('orjson' if orjson else 'json'))
+    print('{:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'size', 'orm ms', 'rows ms', 'orm KiB', 'rows KiB'))
+    with app.app_context():
+        for size in sizes:
+            results = []
+            for page in (orm_page, row_page):
+                # a new session, so the identity map starts empty
+                results.append(measure(
+                    lambda: (page(size), db.session.remove())))
+            for page in (orm_page, row_page):
+                results.append(peak_memory(lambda: page(size)))
+                db.session.remove()
+            print('{:>8} {:>12.2f} {:>12.2f} {:>12.1f} {:>12.1f}'.format(
+                size, *results))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or PAGE_SIZES)
@@ -0,0 +1,51 @@
+'''
+Startup time of a worker.
+
+    python -m benchmarks.bench_startup [runs]
+
+Every run is a new interpreter that imports flaskr, calls create_app()
+and answers a first GET /categories, like a worker started without
+--preload. It prints the median of each step.
+'''
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.common import BENCH_DATABASE_URL, create_bench_app
+
+RUNS = 10
+SCRIPT = '''
+import json, time
+start = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app({'DATABASE_URL': %r})
+created = time.perf_counter()
+app.test_client().get('/categories')
+answered = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first_request': answered - created}))
+'''
+
+
+def run_once(backend_folder):
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT % BENCH_DATABASE_URL],
+        cwd=backend_folder, env=dict(os.environ, PYTHONDONTWRITEBYTECODE=''))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main(runs):
+    create_bench_app()
+    backend_folder = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    results = [run_once(backend_folder) for _ in range(runs)]
+    print('{:>15} {:>10}'.format('step', 'ms'))
+    for step in ('import', 'create_app', 'first_request'):
+        timings = sorted(result[step] * 1000 for result in results)
+        print('{:>15} {:>10.1f}'.format(step, timings[len(timings) // 2]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else RUNS)
@@ -0,0 +1,74 @@
+import os
+import random
+import tempfile
+import time
+
+from flaskr import create_app
+from models import db, Question, Category
+
+# set BENCH_DATABASE_URL to a scratch postgres database to benchmark the
+# real planner, it defaults to a throwaway sqlite file
+BENCH_DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'trivia_bench.db'))
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+WORDS = ['who', 'what', 'which', 'first', 'largest', 'world', 'cup',
+         'painting', 'river', 'king', 'planet', 'movie', 'team', 'city',
+         'element', 'war', 'artist', 'lake', 'palace', 'organ', 'winner']
+
+
+'''
+create_bench_app(category_count, config)
+    builds the app bound to the benchmark database with empty tables and
+    `category_count` categories
+'''
+def create_bench_app(category_count=len(CATEGORIES), config=None):
+    app = create_app(dict(config or {}, DATABASE_URL=BENCH_DATABASE_URL))
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(Category.__table__.insert(), [
+            {'type': CATEGORIES[index] if index < len(CATEGORIES)
+             else 'Category {}'.format(index + 1)}
+            for index in range(category_count)])
+        db.session.commit()
+    app.config['BENCH_CATEGORY_COUNT'] = category_count
+    return app
+
+
+'''
+seed_questions(app, count)
+    grows the questions table to `count` synthetic rows in batches
+'''
+def seed_questions(app, count, batch_size=10000, seed=0):
+    rng = random.Random(seed)
+    category_count = app.config.get('BENCH_CATEGORY_COUNT', len(CATEGORIES))
+    with app.app_context():
+        existing = Question.query.count()
+        while existing < count:
+            size = min(batch_size, count - existing)
+            rows = [{
+                'question': ' '.join(rng.choice(WORDS) for _ in range(8)),
+                'answer': rng.choice(WORDS),
+                'category': rng.randint(1, category_count),
+                'difficulty': rng.randint(1, 5)
+            } for _ in range(size)]
+            db.session.execute(Question.__table__.insert(), rows)
+            db.session.commit()
+            existing += size
+
+
+'''
+measure(call, repeat)
+    runs the call `repeat` times and returns the median latency in ms
+'''
+def measure(call, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
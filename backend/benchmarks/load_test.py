@@ -0,0 +1,118 @@
+'''
+Concurrent load test of a running server, to compare the WSGI app with
+the ASGI app at many concurrent clients.
+
+    gunicorn --workers 4 --threads 8 'flaskr:create_app()' -b :5000
+    uvicorn --factory flaskr.asgi:create_asgi_app --workers 4 --port 5001
+    python -m benchmarks.load_test http://localhost:5000 http://localhost:5001
+
+Every client replays the scenario for --duration seconds over one
+keep-alive connection (reconnecting when the server closes it). 1000
+clients need `ulimit -n` above 1000.
+'''
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+# (method, path, JSON body) replayed by every client
+SCENARIO = [
+    ('GET', '/categories', None),
+    ('GET', '/questions?page=1', None),
+    ('GET', '/categories/3/questions', None),
+    ('POST', '/quizzes', {'previous_questions': [],
+                          'quiz_category': {'id': 0}}),
+    ('POST', '/questions', {'searchTerm': 'what'}),
+]
+
+
+async def read_response(reader):
+    # returns the status and whether the server keeps the connection open
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    keep_alive = status_line.startswith(b'HTTP/1.1')
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        name, value = name.lower(), value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection':
+            keep_alive = value == 'keep-alive'
+    await reader.readexactly(length)
+    return int(status_line.split()[1]), keep_alive
+
+
+async def client(host, port, deadline, latencies, errors):
+    writer = None
+    index = 0
+    while time.perf_counter() < deadline:
+        method, path, body = SCENARIO[index % len(SCENARIO)]
+        index += 1
+        payload = json.dumps(body).encode() if body is not None else b''
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write('{} {} HTTP/1.1\r\nHost: {}\r\n'
+                         'Content-Type: application/json\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(
+                             method, path, host, len(payload)).encode() +
+                         payload)
+            await writer.drain()
+            status, keep_alive = await read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            errors.append('connection')
+            writer = None
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status >= 500:
+            errors.append(status)
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run(url, clients, duration):
+    parts = urlsplit(url)
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[
+        client(parts.hostname, parts.port or 80, deadline, latencies, errors)
+        for _ in range(clients)])
+    latencies.sort()
+    return {
+        'url': url,
+        'clients': clients,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': len(latencies) / duration,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30)
+    args = parser.parse_args()
+    for url in args.urls:
+        print(json.dumps(asyncio.run(run(url, args.clients, args.duration))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+'''
+Latency benchmark of every endpoint, to compare releases.
+
+    python -m benchmarks.suite --rows 100000 --categories 50 \
+        --output bench-1.2.json --compare bench-1.1.json
+
+Seeds a synthetic question bank in BENCH_DATABASE_URL, then drives every
+route through the Flask test client and over HTTP (a threaded server of
+the same app on a local port). For each route it reports p50/p95/p99
+latency, throughput and the number of SQL queries per request. With
+--compare it exits with 1 when a p50 got slower than --tolerance.
+
+The Server-Sent Events of /rooms/<room>/events are not requests that end,
+benchmarks/bench_rooms.py measures them; /metrics is left out too.
+'''
+import argparse
+import http.client
+import json
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks.common import BENCH_DATABASE_URL, create_bench_app, \
+    seed_questions
+from flaskr.limits import DEFAULT_LIMITS
+from models import db, Question, question_changed
+
+# the questions of a POST /questions/bulk body of the suite
+IMPORT_ROWS = 10
+IMPORT_QUESTION = 'Which benchmark imported question {} is this?'
+
+
+'''
+scenarios(app, rows, requests)
+    the requests of the suite as (name, method, path, body): the path is
+    a string or a function of the request number, the body is JSON or a
+    NDJSON string. the sessions, rooms and questions they need are made
+    here, not timed. the writes delete what they create so every run sees
+    the same table, the imported rows are deleted by remove_imported()
+'''
+def scenarios(app, rows, requests):
+    deep_page = max(rows // 20, 1)
+    with app.app_context():
+        first_id, last_id = db.session.query(
+            db.func.min(Question.id), db.func.max(Question.id)).one()
+    quiz = {'previous_questions': [], 'quiz_category': {'id': 3}}
+    client = app.test_client()
+    # the questions deleted by delete_question, one per request
+    deleted = [client.post('/questions?return=minimal', json={
+        'question': 'Which benchmark deletes question {}?'.format(index),
+        'answer': 'suite', 'category': 3, 'difficulty': 1
+    }).get_json()['created'] for index in range(requests)]
+    session = client.post('/quizzes/sessions', json={
+        'quiz_category': {'id': 3}}).get_json()['session']
+    room = client.post('/rooms', json={
+        'quiz_category': {'id': 3}}).get_json()
+    host = {'host_key': room['host_key']}
+    # a room with an open round for the answers
+    answered = client.post('/rooms', json={
+        'quiz_category': {'id': 3}}).get_json()
+    question = client.post('/rooms/{}/next'.format(answered['room']), json={
+        'host_key': answered['host_key']}).get_json()['question']
+    imported = ''.join(json.dumps({
+        'question': IMPORT_QUESTION.format(index), 'answer': 'suite',
+        'category': 3, 'difficulty': 1}) + '\n'
+        for index in range(IMPORT_ROWS))
+    result_token = app.extensions['quiz_results'].issue(first_id)
+    return [
+        ('categories', 'GET', '/categories', None),
+        ('categories_with_counts', 'GET', '/categories?with_counts=true',
+         None),
+        ('stats', 'GET', '/stats', None),
+        ('questions_first_page', 'GET', '/questions?page=1', None),
+        ('questions_deep_page', 'GET',
+         '/questions?page={}'.format(deep_page), None),
+        ('questions_after_id', 'GET',
+         '/questions?after_id={}'.format(deep_page * 10), None),
+        ('category_questions', 'GET', '/categories/3/questions', None),
+        ('search', 'POST', '/questions', {'searchTerm': 'largest lake'}),
+        ('suggest', 'GET', '/questions/suggest?q=larg', None),
+        ('quiz', 'POST', '/quizzes', quiz),
+        ('quiz_late', 'POST', '/quizzes', dict(
+            quiz, previous_questions=list(range(1, min(last_id, 500))))),
+        ('quiz_with_results', 'POST', '/quizzes', dict(
+            quiz, previous_questions=[first_id], results=[
+                {'player': 'suite', 'question_id': first_id,
+                 'answer': 'suite', 'token': result_token}])),
+        ('quiz_batch', 'POST', '/quizzes/batch', dict(quiz, count=5)),
+        ('leaderboard', 'GET', '/leaderboard?category=3', None),
+        ('quiz_session_start', 'POST', '/quizzes/sessions',
+         {'quiz_category': {'id': 3}}),
+        ('quiz_session_next', 'POST',
+         '/quizzes/sessions/{}/next'.format(session), None),
+        ('room_open', 'POST', '/rooms', {'quiz_category': {'id': 3}}),
+        ('room_next_round', 'POST', '/rooms/{}/next'.format(room['room']),
+         host),
+        ('room_answer', 'POST', '/rooms/{}/answers'.format(
+            answered['room']), {'player': 'suite',
+                                'question_id': question['id'],
+                                'answer': 'suite'}),
+        ('create_question', 'POST', '/questions?return=minimal', {
+            'question': 'Which benchmark created this question?',
+            'answer': 'suite', 'category': 3, 'difficulty': 1}),
+        ('delete_question', 'DELETE',
+         lambda index: '/questions/{}?return=minimal'.format(
+             deleted[index]), None),
+        ('bulk_import', 'POST', '/questions/bulk', imported),
+        ('export', 'GET', '/questions/export', None),
+    ]
+
+
+def remove_imported(app):
+    with app.app_context():
+        Question.query.filter(Question.question.in_([
+            IMPORT_QUESTION.format(index) for index in range(IMPORT_ROWS)
+        ])).delete(synchronize_session=False)
+        db.session.commit()
+        # the in-memory indexes hold the deleted rows
+        question_changed('bulk', None)
+
+
+class QueryCounter:
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        self.count += 1
+
+
+def summarize(latencies, queries, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        index = min(int(len(latencies) * fraction), len(latencies) - 1)
+        return round(latencies[index] * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'throughput': round(len(latencies) / elapsed, 1),
+        'queries_per_request': round(queries / len(latencies), 2)
+    }
+
+
+class TestClientDriver:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, method, path, body):
+        if isinstance(body, str):
+            response = self.client.open(
+                path, method=method, data=body,
+                content_type='application/x-ndjson')
+        else:
+            response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_json()
+
+    def close(self):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args):
+        pass
+
+
+class HTTPDriver:
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def send(self, method, path, body):
+        # a new connection per request, the development server does not
+        # keep them alive
+        connection = http.client.HTTPConnection('127.0.0.1',
+                                                self.server.server_port)
+        if isinstance(body, str):
+            payload, content_type = body, 'application/x-ndjson'
+        else:
+            payload = json.dumps(body) if body is not None else None
+            content_type = 'application/json'
+        connection.request(method, path, payload,
+                           {'Content-Type': content_type})
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        if response.getheader('Content-Type') != 'application/json':
+            return response.status, None
+        return response.status, json.loads(data) if data else None
+
+    def close(self):
+        self.server.shutdown()
+
+
+def run_scenario(driver, counter, method, path, body, requests):
+    latencies = []
+    created = []
+    queries = counter.count
+    start = time.perf_counter()
+    for index in range(requests):
+        request_path = path(index) if callable(path) else path
+        request_start = time.perf_counter()
+        status, data = driver.send(method, request_path, body)
+        latencies.append(time.perf_counter() - request_start)
+        if status >= 500:
+            raise RuntimeError('{} {} answered {}'.format(
+                method, request_path, status))
+        if data and 'created' in data:
+            created.append(data['created'])
+    elapsed = time.perf_counter() - start
+    result = summarize(latencies, counter.count - queries, elapsed)
+    for question_id in created:
+        driver.send('DELETE', '/questions/{}?return=minimal'.format(
+            question_id), None)
+    return result
+
+
+def run_suite(rows, categories, requests, modes, config):
+    app = create_bench_app(categories, config)
+    seed_questions(app, rows)
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+        dialect = db.engine.dialect.name
+    results = {}
+    for mode in modes:
+        driver = (TestClientDriver if mode == 'test_client'
+                  else HTTPDriver)(app)
+        try:
+            results[mode] = {
+                name: run_scenario(driver, counter, method, path, body,
+                                   requests)
+                for name, method, path, body
+                in scenarios(app, rows, requests)
+            }
+        finally:
+            driver.close()
+            remove_imported(app)
+    return {
+        'meta': {
+            'date': datetime.utcnow().isoformat() + 'Z',
+            'rows': rows,
+            'categories': categories,
+            'requests': requests,
+            'database': dialect,
+            'config': config,
+            'python': platform.python_version()
+        },
+        'results': results
+    }
+
+
+'''
+compare(report, baseline, tolerance)
+    returns the routes whose p50 is more than `tolerance` slower than the
+    same route of the baseline report
+'''
+def compare(report, baseline, tolerance):
+    regressions = []
+    for mode, routes in report['results'].items():
+        for name, result in routes.items():
+            previous = baseline['results'].get(mode, {}).get(name)
+            if previous and result['p50_ms'] > previous['p50_ms'] * (
+                    1 + tolerance):
+                regressions.append('{} {}: p50 {} ms, was {} ms'.format(
+                    mode, name, result['p50_ms'], previous['p50_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and mode')
+    parser.add_argument('--modes', nargs='+',
+                        default=['test_client', 'http'],
+                        choices=['test_client', 'http'])
+    parser.add_argument('--cold', action='store_true',
+                        help='disable the read cache')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # create_question posts the same question, it's inserted every time
+    # but still checked for near duplicates. the suite sends more requests
+    # than a client may, without the rate limits it measures 429s
+    config = {'DEDUPE': 'flag',
+              'RATE_LIMITS': {name: None for name in DEFAULT_LIMITS}}
+    if args.cold:
+        config['READ_CACHE_MAX'] = 0
+    report = run_suite(max(args.rows, 1), max(args.categories, 3),
+                       args.requests, args.modes, config)
+    print('database: {}'.format(BENCH_DATABASE_URL))
+    print('{:<12} {:<22} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+        'mode', 'route', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s',
+        'queries'))
+    for mode, routes in report['results'].items():
+        for name, result in routes.items():
+            print('{:<12} {:<22} {:>9} {:>9} {:>9} {:>10} {:>8}'.format(
+                mode, name, result['p50_ms'], result['p95_ms'],
+                result['p99_ms'], result['throughput'],
+                result['queries_per_request']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline),
+                                  args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,86 @@
 import os
-from flask import Flask, request, abort, jsonify
+import click
+from flask import (Flask, request, abort, jsonify, Response,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10
-
-
-def pagination(request, questions_list):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    formatted_questions = [question.format() for question in
-                           questions_list[start:end]]
-    return formatted_questions
+from models import setup_db, db, Question, Category, question_changed
+from .pagination import (pagination, page_args, wants_minimal,
+                         shape_questions)
+from .search import QuestionSearch
+from .suggest import Suggestions, SUGGEST_LIMIT, SUGGEST_MAX_LIMIT
+from .dedupe import Deduplicator, scan_duplicates
+from .quiz import QuestionSelector, QUIZ_BATCH_MAX
+from .quiz_sessions import QuizSessions
+from .rooms import QuizRooms, is_host, ROOM_PLAYER_MAX_LENGTH
+from .results import (QuizResults, parse_results, load_leaderboard,
+                      LEADERBOARD_SIZE, LEADERBOARD_MAX_SIZE)
+from .cache import ReadCache
+from .conditional import conditional
+from .bulk import (read_rows, import_questions, export_questions,
+                   IMPORT_BATCH_SIZE)
+from .metrics import RequestMetrics, timing
+from .compression import Compression
+from .limits import Admission
+from .catalog import Catalog, CatalogWatcher
+from .serialization import load_question_row, format_row, format_rows
+from .stats import (load_question_counts, snapshot_question_counts,
+                    summarize_counts)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
 
+    metrics = RequestMetrics(app)
+    Compression(app)
+    admission = Admission(app)
     CORS(app)
+    search = QuestionSearch(app)
+    watcher = CatalogWatcher(app)
+    suggestions = Suggestions(app, watcher)
+    dedupe = Deduplicator(app, watcher)
+    catalog = None
+    if app.config.get('CATALOG', False):
+        # the categories and questions served from memory
+        catalog = Catalog(app, watcher)
+        with app.app_context():
+            watcher.start()
+            catalog.refresh()
+    selector = QuestionSelector(app, catalog)
+    quiz_sessions = QuizSessions(app, selector)
+    results = QuizResults(app)
+    rooms = QuizRooms(app, selector, results)
+    cache = ReadCache(app, watcher=watcher, catalog=catalog)
+
+    def load_categories():
+        # [id, type] pairs, so the order and the ids survive a JSON cache
+        return [[category.id, category.type] for category in
+                Category.query.order_by(Category.id)]
+
+    def get_category_list():
+        if catalog is not None:
+            return catalog.categories()
+        return cache.get_or_load('categories', ['all'], load_categories)
+
+    def get_question_counts():
+        # [category, difficulty, count], kept until a question changes
+        if catalog is not None:
+            return snapshot_question_counts(catalog.current())
+        return cache.get_or_load('questions', ['counts'],
+                                 load_question_counts)
+
+    def load_page(query):
+        def loader():
+            formatted_questions, total_questions = pagination(request,
+                                                              query)
+            return {"questions": formatted_questions,
+                    "total_questions": total_questions}
+        return loader
 
     @app.after_request
     def after_request(response):
@@ -34,35 +91,69 @@ def create_app(test_config=None):
                              'GET,PATCH,POST,DELETE,OPTIONS')
         return response
 
+    @app.route('/metrics')
+    def get_metrics():
+        text = (metrics.render(cache) + admission.render() +
+                suggestions.render() + rooms.render() + results.render())
+        if catalog is not None:
+            text += catalog.render()
+        return Response(text,
+                        mimetype='text/plain; version=0.0.4')
+
     @app.route('/categories')
+    # the counts of ?with_counts=true change with the questions
+    @conditional(cache, 'categories', 'questions')
     def get_categories():
 
-        categories = Category.query.all()
-        category_dict = {category.id: category.type for category in categories}
+        categories = get_category_list()
+        category_dict = {id: type for id, type in categories}
 
         # check the len, if no categories exist, abort the request and
         # handle it.
         if len(categories) == 0:
             abort(404)
 
+        if request.args.get('with_counts') != 'true':
+            return jsonify({
+              "success": True,
+              "categories": category_dict
+            })
+
+        stats = summarize_counts(get_question_counts(), categories)
         return jsonify({
           "success": True,
-          "categories": category_dict
+          "categories": category_dict,
+          "question_counts": {id: category['total_questions'] for id,
+                              category in stats['categories'].items()},
+          "total_questions": stats['total_questions']
+        })
+
+    @app.route('/stats')
+    @conditional(cache, 'categories', 'questions')
+    def get_stats():
+
+        stats = summarize_counts(get_question_counts(), get_category_list())
+        return jsonify({
+          "success": True,
+          "total_questions": stats['total_questions'],
+          "categories": stats['categories'],
+          "difficulties": stats['difficulties']
         })
 
     @app.route('/questions')
+    @conditional(cache, 'questions', 'categories')
     def get_questions():
-        questions = Question.query.all()
-        paged_questions = pagination(request, questions)
-        if(len(paged_questions) == 0):
+        page = cache.get_or_load('questions', ['all', *page_args(request)],
+                                 load_page(Question.query))
+        if(len(page['questions']) == 0):
             abort(404)
 
-        categories = Category.query.all()
-        category_dict = [category.type for category in categories]
+        categories = get_category_list()
+        category_dict = [type for id, type in categories]
         return jsonify({
           "success": True,
-          "questions": paged_questions,
-          "total_questions": len(questions),
+          "questions": shape_questions(request, page['questions']),
+          "total_questions": page['total_questions'],
           "categories": category_dict,
           "current_category": None
         })
@@ -76,13 +167,22 @@ def create_app(test_config=None):
                 abort(404)
             # delete the question
             question.delete()
-            questions = Question.query.all()
-            # return the current page after deleting the question
-            formatted_questions = pagination(request, questions)
+
+            if wants_minimal(request):
+                return jsonify({
+                  "success": True,
+                  "deleted": question_id
+                })
+
+            # return the current page after deleting the question, it's
+            # cached for the listing that usually follows
+            page = cache.get_or_load('questions',
+                                     ['all', *page_args(request)],
+                                     load_page(Question.query))
 
             return jsonify({
               "success": True,
-              "questions": formatted_questions,
+              "questions": shape_questions(request, page['questions']),
               "deleted": question_id
             })
 
@@ -96,18 +196,20 @@ def create_app(test_config=None):
         search_term = body.get('searchTerm', None)
 
         if search_term:
-            # search for question
-            questions = Question.query.filter(
-              Question.question.ilike(f'%{search_term}%')).all()
-
-            if len(questions) == 0:
+            # search for question, ranked and paginated by the search index
+            page, _ = page_args(request)
+            questions, total_questions = search.search(search_term, page)
+            if total_questions == 0:
                 abort(404)
 
-            formatted_questions = pagination(request, questions)
+            with timing('serialize'):
+                formatted_questions = [question.format()
+                                       for question in questions]
+
             return jsonify({
               "success": True,
-              "questions": formatted_questions,
-              "total_questions": len(questions),
+              "questions": shape_questions(request, formatted_questions),
+              "total_questions": total_questions,
               "current_category": None
             }), 200
 
@@ -123,41 +225,161 @@ def create_app(test_config=None):
                (category is None) or (difficulty is None)):
                 abort(400)
 
+            try:
+                category = int(category)
+                difficulty = int(difficulty)
+            except (TypeError, ValueError):
+                abort(400)
+
+            # abort if the category does not exist (UNPROCESSABLE)
+            if Category.query.get(category) is None:
+                abort(422)
+
+            # a near duplicate of a question of the bank is inserted and
+            # reported, or rejected with DEDUPE='reject' when it has the
+            # same question or answer
+            duplicate = dedupe.find(question_text, answer)
+            if dedupe.rejects(duplicate):
+                return jsonify({
+                  'success': False,
+                  'error': 409,
+                  'message': 'near duplicate question',
+                  'duplicate_of': duplicate[0]
+                }), 409
+
             # create the question and insert it in the table
             question = Question(question_text, answer, category, difficulty)
             question.insert()
 
-            # paginate the current page
-            questions = Question.query.all()
-            formatted_questions = pagination(request, questions)
-
-            return jsonify({
+            created = {
               'success': True,
-              'questions': formatted_questions,
               'created': question.id,
-              'question_created': question.question,
-              'total_questions': len(questions)
-            }), 200
+              'question_created': question.question
+            }
+            if duplicate is not None:
+                created['duplicate_of'] = duplicate[0]
+
+            if wants_minimal(request):
+                return jsonify(created), 200
+
+            # paginate the current page, it's cached for the listing that
+            # usually follows
+            page = cache.get_or_load('questions',
+                                     ['all', *page_args(request)],
+                                     load_page(Question.query))
+
+            created['questions'] = shape_questions(request,
+                                                   page['questions'])
+            created['total_questions'] = page['total_questions']
+            return jsonify(created), 200
+
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_import_questions():
+
+        content_type = request.mimetype or 'application/x-ndjson'
+        if content_type not in ('application/x-ndjson', 'application/jsonl',
+                                'application/json', 'text/csv'):
+            abort(400)
+
+        # the body is read and inserted in batches while it's streamed
+        inserted, errors, error_count, duplicates = import_questions(
+          read_rows(request.stream, content_type), dedupe=dedupe)
+
+        return jsonify({
+          "success": True,
+          "inserted": inserted,
+          "total_errors": error_count,
+          "errors": errors,
+          "duplicates": duplicates
+        })
+
+    @app.route('/questions/suggest')
+    def suggest_questions():
+
+        # the questions with a word starting with `q`, for autocomplete
+        prefix = request.args.get('q', '')
+        limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+        if not prefix.strip() or not 1 <= limit <= SUGGEST_MAX_LIMIT:
+            abort(400)
+
+        return jsonify({
+          "success": True,
+          "suggestions": [{"id": question_id, "question": text} for
+                          question_id, text in
+                          suggestions.suggest(prefix, limit)]
+        })
+
+    @app.route('/questions/export')
+    def bulk_export_questions():
+
+        return Response(stream_with_context(export_questions()),
+                        mimetype='application/x-ndjson')
+
+    @app.cli.command('import-questions')
+    @click.argument('path', type=click.File('rb'))
+    def import_questions_command(path):
+        """Import the questions of a NDJSON or CSV file."""
+        content_type = ('text/csv' if path.name.endswith('.csv')
+                        else 'application/x-ndjson')
+        inserted, errors, error_count, duplicates = import_questions(
+          read_rows(path, content_type), dedupe=dedupe)
+        for error in errors + duplicates:
+            click.echo('line {line}: {message}'.format(**error), err=True)
+        click.echo('{} questions imported, {} rows skipped'.format(
+          inserted, error_count))
+
+    @app.cli.command('dedupe')
+    @click.option('--threshold', type=float, default=dedupe.threshold,
+                  help='Similarity above which a question is a duplicate.')
+    @click.option('--delete', is_flag=True,
+                  help='Delete the duplicates with the same question or '
+                       'answer, the oldest copy is kept.')
+    def dedupe_command(threshold, delete):
+        """Find the near duplicate questions of the whole table."""
+        duplicate_ids = []
+        for question_id, original_id, score, confirmed in scan_duplicates(
+                threshold):
+            click.echo('question {} is a near duplicate of question {} '
+                       '({:.2f}{})'.format(question_id, original_id, score,
+                                           '' if confirmed else
+                                           ', not confirmed'))
+            if confirmed or not delete:
+                duplicate_ids.append(question_id)
+        if delete:
+            for start in range(0, len(duplicate_ids), IMPORT_BATCH_SIZE):
+                Question.query.filter(Question.id.in_(
+                  duplicate_ids[start:start + IMPORT_BATCH_SIZE])
+                ).delete(synchronize_session=False)
+                db.session.commit()
+            question_changed('bulk', None)
+        click.echo('{} near duplicates {}'.format(
+          len(duplicate_ids), 'deleted' if delete else 'found'))
 
     @app.route('/categories/<int:category_id>/questions')
+    @conditional(cache, 'questions')
     def get_questions_by_category(category_id):
 
-        # get all the questions by category
-        questions = Question.query.filter(Question.category ==
-                                          str(category_id)).all()
+        if catalog is not None:
+            page = catalog.page(category_id, *page_args(request))
+        else:
+            # get all the questions by category
+            questions = Question.query.filter(
+              Question.category == category_id)
 
-        formatted_questions = pagination(request, questions)
+            page = cache.get_or_load(
+              'questions', ['category', category_id, *page_args(request)],
+              load_page(questions))
 
         # abort with 404 if no questions by that category or he
         # enter page that does not exist
-        if len(formatted_questions) == 0:
+        if len(page['questions']) == 0:
             abort(404)
 
         return jsonify({
           "success": True,
-          "questions": formatted_questions,
+          "questions": shape_questions(request, page['questions']),
           "current_category": category_id,
-          "total_questions": len(questions)
+          "total_questions": page['total_questions']
         })
 
     @app.route('/quizzes', methods=['POST'])
@@ -169,55 +391,257 @@ def create_app(test_config=None):
             # rise a BAD REQUEST, if one of the values are NONE
             abort(400)
 
-        # getting the previous questions and the category
-        category_type = body.get('quiz_category')['id']
-        previous_questions = body.get('previous_questions')
-        category_questions = []
+        # getting the previous questions and the category, and the
+        # optional difficulty or the streak of an adaptive quiz
+        try:
+            category_type = int(body.get('quiz_category')['id'])
+            previous_questions = set(body.get('previous_questions'))
+            difficulty = body.get('difficulty', None)
+            if difficulty is not None:
+                difficulty = int(difficulty)
+            streak = max(int(body.get('streak', 0)), 0)
+            # the answers to the previous questions, for the leaderboard
+            answers = parse_results(body.get('results', []))
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+
+        # abort if this category does not have questions
+        if len(selector.category_ids(category_type)) == 0:
+            abort(404)
 
-        if category_type == 0:
-            # get all category
-            category_questions = Question.query.all()
-        else:
-            # getting the all questions of the requested category
-            category_questions = Question.query.filter(
-              Question.category == str(category_type)).all()
+        # only the answers to questions served in this quiz, checked here
+        results.record(category_type,
+                       results.verify(answers, previous_questions))
+
+        if difficulty is None and body.get('adaptive', False):
+            difficulty = selector.target_difficulty(category_type, streak)
+
+        random_question = selector.pick(category_type, previous_questions,
+                                        difficulty)
+
+        if random_question is None:
+            # This mean he have used all the questions available
+            return jsonify({
+              "success": True
+            })
+
+        question = format_row(random_question)
+        return jsonify({
+          "success": True,
+          "question": question,
+          "result_token": results.issue(question['id'])
+        })
+
+    @app.route('/quizzes/batch', methods=['POST'])
+    def play_quiz_batch():
+
+        body = request.get_json()
+
+        if not ('quiz_category' in body and 'previous_questions' in body):
+            # rise a BAD REQUEST, if one of the values are NONE
+            abort(400)
+
+        # the next `count` questions of the quiz, in one request
+        try:
+            category_type = int(body.get('quiz_category')['id'])
+            previous_questions = set(body.get('previous_questions'))
+            count = int(body.get('count', 1))
+            answers = parse_results(body.get('results', []))
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        if not 1 <= count <= QUIZ_BATCH_MAX:
+            abort(400)
 
         # abort if this category does not have questions
-        if len(category_questions) == 0:
+        if len(selector.category_ids(category_type)) == 0:
             abort(404)
 
-        def new_questions_filter(previous_questions, all_questions):
-            # this method will filter the questions, and get new questions ONLY
-            new_questions = []
-            for check_question in all_questions:
-                its_new = True
-                for used_question_id in previous_questions:
-                    if check_question.id == used_question_id:
-                        its_new = False
+        results.record(category_type,
+                       results.verify(answers, previous_questions))
 
-                if its_new:
-                    new_questions.append(check_question.format())
-            return new_questions
+        questions = format_rows(selector.pick_many(
+            category_type, previous_questions, count))
 
-        def random_question_generator(new_questions):
-            # from new questions, this method will get random questions
-            index = random.randint(0, len(new_questions) - 1)
-            return new_questions[index]
+        # fewer than `count` (or none) when the category is almost played,
+        # the result tokens in the order of the questions
+        return jsonify({
+          "success": True,
+          "questions": shape_questions(request, questions),
+          "result_tokens": [results.issue(question['id'])
+                            for question in questions]
+        })
 
-        new_questions = new_questions_filter(previous_questions,
-                                             category_questions)
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def start_quiz_session():
 
-        if len(new_questions) == 0:
-            # This mean he have used all the questions available
+        body = request.get_json()
+
+        try:
+            category_type = int(body.get('quiz_category')['id'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # rise a BAD REQUEST, if the category is missing
+            abort(400)
+
+        # abort if this category does not have questions
+        if len(selector.category_ids(category_type)) == 0:
+            abort(404)
+
+        token, total_questions = quiz_sessions.start(category_type)
+
+        return jsonify({
+          "success": True,
+          "session": token,
+          "total_questions": total_questions
+        })
+
+    @app.route('/quizzes/sessions/<token>/next', methods=['POST'])
+    def next_quiz_question(token):
+
+        while True:
+            try:
+                question_id = quiz_sessions.next_id(token)
+            except KeyError:
+                # unknown or expired session
+                abort(404)
+
+            if question_id is None:
+                # This mean he have used all the questions available
+                return jsonify({
+                  "success": True
+                })
+
+            # skip the questions deleted since the session started
+            question = load_question_row(question_id)
+            if question is not None:
+                return jsonify({
+                  "success": True,
+                  "question": format_row(question)
+                })
+
+    @app.route('/rooms', methods=['POST'])
+    def open_room():
+
+        body = request.get_json()
+
+        try:
+            category_type = int(body.get('quiz_category')['id'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # rise a BAD REQUEST, if the category is missing
+            abort(400)
+
+        # abort if this category does not have questions, or if the rooms
+        # are turned off (ROOM_PUBSUB='off')
+        if (not rooms.enabled or
+                len(selector.category_ids(category_type)) == 0):
+            abort(404)
+
+        room, host_key, total_questions = rooms.open(category_type)
+
+        return jsonify({
+          "success": True,
+          "room": room,
+          "host_key": host_key,
+          "total_questions": total_questions
+        })
+
+    @app.route('/rooms/<room>/events')
+    def stream_room(room):
+
+        try:
+            events = rooms.stream(room)
+        except KeyError:
+            # unknown or closed room
+            abort(404)
+
+        return Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+    def check_host(room):
+        body = request.get_json(silent=True) or {}
+        host_key = body.get('host_key')
+        if not is_host(room, host_key):
+            abort(403)
+
+    @app.route('/rooms/<room>/next', methods=['POST'])
+    def next_room_round(room):
+
+        check_host(room)
+        try:
+            next_round = rooms.next_round(room)
+        except KeyError:
+            abort(404)
+
+        if next_round is None:
+            # all the questions have been played, the room is closed
             return jsonify({
               "success": True
             })
 
-        random_question = random_question_generator(new_questions)
+        round_number, question = next_round
+        return jsonify({
+          "success": True,
+          "round": round_number,
+          "question": format_row(question)
+        })
+
+    @app.route('/rooms/<room>/answers', methods=['POST'])
+    def answer_room_question(room):
+
+        body = request.get_json(silent=True) or {}
+        player = body.get('player')
+        question_id = body.get('question_id')
+        if (not isinstance(player, str) or not player.strip() or
+                len(player) > ROOM_PLAYER_MAX_LENGTH or
+                not isinstance(question_id, int) or
+                not isinstance(body.get('answer'), str)):
+            abort(400)
+
+        try:
+            correct = rooms.answer(room, player.strip(), question_id,
+                                   body['answer'])
+        except KeyError:
+            abort(404)
+
+        if correct is None:
+            # the round of this question is over
+            abort(422)
 
         return jsonify({
           "success": True,
-          "question": random_question
+          "correct": correct
+        })
+
+    @app.route('/rooms/<room>/close', methods=['POST'])
+    def close_room(room):
+
+        check_host(room)
+        try:
+            rooms.close(room)
+        except KeyError:
+            abort(404)
+
+        return jsonify({
+          "success": True
+        })
+
+    @app.route('/leaderboard')
+    def get_leaderboard():
+
+        # the best players of the quizzes of a category, 0 (the default)
+        # is every quiz
+        category_id = request.args.get('category', 0, type=int)
+        limit = request.args.get('limit', LEADERBOARD_SIZE, type=int)
+        if not 1 <= limit <= LEADERBOARD_MAX_SIZE:
+            abort(400)
+        if category_id != 0 and category_id not in {
+                id for id, _ in get_category_list()}:
+            abort(404)
+
+        return jsonify({
+          "success": True,
+          "category": category_id,
+          "leaderboard": load_leaderboard(category_id, limit)
         })
 
     @app.errorhandler(404)
@@ -236,6 +660,14 @@ def create_app(test_config=None):
           "message": "bad request"
         }), 400
 
+    @app.errorhandler(403)
+    def forbidden(error):
+        return jsonify({
+          "success": False,
+          "error": 403,
+          "message": "forbidden"
+        }), 403
+
     @app.errorhandler(422)
     def unprocessable_entity(error):
         return jsonify({
@@ -244,4 +676,20 @@ def create_app(test_config=None):
           "message": "unprocessable request"
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+          "success": False,
+          "error": 429,
+          "message": "too many requests"
+        }), 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+          "success": False,
+          "error": 503,
+          "message": "service unavailable"
+        }), 503
+
     return app
@@ -0,0 +1,533 @@
+'''
+ASGI serving mode of the trivia API.
+
+    pip install -r requirements-asgi.txt
+    uvicorn --factory flaskr.asgi:create_asgi_app --workers 4
+
+It serves the question, category and quiz routes of create_app with the
+same JSON (errors included):
+
+    GET /categories, GET /stats, GET /questions, POST /questions (search
+    and create, with the near duplicate check), DELETE /questions/<id>,
+    GET /categories/<id>/questions, POST /quizzes, POST /quizzes/batch
+
+but every request runs on the event loop with an asyncpg connection pool,
+so a worker keeps serving while its queries wait on postgres. The routes
+that need the state of the sync app (the quiz sessions, the rooms, the
+leaderboard, the bulk import, the export and the suggestions) answer 501,
+they are served by create_app only. The database is DATABASE_URL, like
+setup_db.
+'''
+import asyncio
+import json
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from models import default_database_path
+from .dedupe import build_index, signature, DEDUPE_THRESHOLD
+from .pagination import QUESTIONS_PER_PAGE
+from .quiz import (draw_unseen_id, build_buckets, draw_by_difficulty,
+                   target_difficulty, sample_unseen_ids, QUIZ_BATCH_MAX)
+from .search import tokenize
+from .stats import summarize_counts
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'Resource Not Found',
+    405: 'method not allowed',
+    409: 'near duplicate question',
+    422: 'unprocessable request',
+    501: 'not implemented'
+}
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,PATCH,POST,DELETE,OPTIONS')
+]
+QUESTION_COLUMNS = 'id, question, answer, category, difficulty'
+SEARCH_VECTOR = "to_tsvector('simple', coalesce(question, ''))"
+# routes of create_app the ASGI app doesn't serve
+SYNC_ONLY_ROUTES = re.compile(
+    r'^/(quizzes/sessions(/.*)?|questions/(bulk|export|suggest)|'
+    r'rooms(/.*)?|leaderboard)$')
+# draws of a quiz question retried when the drawn one was just deleted
+QUIZ_DRAW_ATTEMPTS = 3
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, **extra):
+        super().__init__(status)
+        self.status = status
+        self.extra = extra
+
+
+'''
+Request
+    the parts of an ASGI http request the routes use
+'''
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {key: values[0] for key, values in
+                     parse_qs(scope['query_string'].decode()).items()}
+        self.body = body
+
+    def arg(self, name, default=None, type=int):
+        try:
+            return type(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    def get_json(self):
+        try:
+            body = json.loads(self.body or b'null')
+        except ValueError:
+            raise HTTPError(400)
+        if not isinstance(body, dict):
+            raise HTTPError(400)
+        return body
+
+
+def format_question(row):
+    return {
+        'id': row['id'],
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': row['category'],
+        'difficulty': row['difficulty']
+    }
+
+
+'''
+TriviaASGI
+    the routes of flaskr/__init__.py written against an asyncpg pool.
+    the quiz draws use the in-memory category ids of the sync app, the
+    near duplicate check its MinHashIndex. both are loaded again after
+    `quiz_ids_ttl` seconds, for the writes of the other workers, the
+    index by a thread in the background.
+'''
+class TriviaASGI:
+
+    def __init__(self, database_url=None, pool=None, quiz_ids_ttl=60):
+        self.database_url = (database_url or
+                             os.environ.get('DATABASE_URL') or
+                             default_database_path)
+        self.pool = pool
+        self.quiz_ids_ttl = quiz_ids_ttl
+        self.category_ids = {}
+        self.dedupe_mode = os.environ.get('DEDUPE', 'flag')
+        self.dedupe_threshold = float(os.environ.get('DEDUPE_THRESHOLD',
+                                                     DEDUPE_THRESHOLD))
+        # (loaded at, MinHashIndex) of the questions table, the task that
+        # builds the next one and the (id, signature or None) changes made
+        # meanwhile
+        self.dedupe_index = None
+        self.dedupe_build = None
+        self.dedupe_changes = []
+        self.routes = [
+            ('GET', re.compile(r'^/categories$'), self.get_categories),
+            ('GET', re.compile(r'^/stats$'), self.get_stats),
+            ('GET', re.compile(r'^/questions$'), self.get_questions),
+            ('DELETE', re.compile(r'^/questions/(\d+)$'),
+             self.delete_question),
+            ('POST', re.compile(r'^/questions$'), self.create_question),
+            ('GET', re.compile(r'^/categories/(\d+)/questions$'),
+             self.get_questions_by_category),
+            ('POST', re.compile(r'^/quizzes$'), self.play_quiz),
+            ('POST', re.compile(r'^/quizzes/batch$'), self.play_quiz_batch),
+        ]
+
+    async def startup(self):
+        if self.pool is None:
+            import asyncpg
+            # asyncpg takes a plain postgresql:// dsn, without the driver
+            dsn = re.sub(r'^postgresql\+\w+://', 'postgresql://',
+                         self.database_url)
+            self.pool = await asyncpg.create_pool(
+                dsn,
+                min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+                max_size=int(os.environ.get('DB_POOL_SIZE', 10)))
+
+    async def shutdown(self):
+        if self.pool is not None and hasattr(self.pool, 'close'):
+            await self.pool.close()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle(self, scope, receive, send):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        request = Request(scope, body)
+
+        try:
+            if request.method == 'OPTIONS':
+                status, payload = 200, None
+            else:
+                status, payload = 200, await self.dispatch(request)
+        except HTTPError as error:
+            status, payload = error.status, {
+                'success': False,
+                'error': error.status,
+                'message': ERROR_MESSAGES[error.status]
+            }
+            payload.update(error.extra)
+
+        content = b'' if payload is None else json.dumps(payload).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(content)).encode())
+                        ] + CORS_HEADERS
+        })
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def dispatch(self, request):
+        if SYNC_ONLY_ROUTES.match(request.path):
+            raise HTTPError(501)
+        path_found = False
+        for method, pattern, view in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            path_found = True
+            if method == request.method:
+                if self.pool is None:
+                    await self.startup()
+                async with self.pool.acquire() as connection:
+                    return await view(connection, request,
+                                      *[int(group) for group in
+                                        match.groups()])
+        raise HTTPError(405 if path_found else 404)
+
+    async def load_categories(self, connection):
+        return await connection.fetch(
+            'SELECT id, type FROM categories ORDER BY id')
+
+    async def load_counts(self, connection, categories):
+        rows = await connection.fetch(
+            'SELECT category, difficulty, count(id) FROM questions '
+            'GROUP BY category, difficulty ORDER BY category, difficulty')
+        return summarize_counts(
+            [tuple(row) for row in rows],
+            [(row['id'], row['type']) for row in categories])
+
+    async def paginate(self, connection, request, where='', *params):
+        # one page with LIMIT/OFFSET or after_id, and a COUNT
+        page = max(request.arg('page', 1), 1)
+        after_id = request.arg('after_id')
+        conditions = [where] if where else []
+        page_params = list(params)
+        if after_id is not None:
+            page_params.append(after_id)
+            conditions.append('id > ${}'.format(len(page_params)))
+            offset = 0
+        else:
+            offset = (page - 1) * QUESTIONS_PER_PAGE
+        clause = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        rows = await connection.fetch(
+            'SELECT {} FROM questions{} ORDER BY id LIMIT {} OFFSET {}'
+            .format(QUESTION_COLUMNS, clause, QUESTIONS_PER_PAGE, offset),
+            *page_params)
+        total = await connection.fetchval(
+            'SELECT count(id) FROM questions' +
+            (' WHERE ' + where if where else ''), *params)
+        return [format_question(row) for row in rows], total
+
+    async def get_categories(self, connection, request):
+        categories = await self.load_categories(connection)
+        if len(categories) == 0:
+            raise HTTPError(404)
+        category_dict = {row['id']: row['type'] for row in categories}
+        if request.args.get('with_counts') != 'true':
+            return {'success': True, 'categories': category_dict}
+        stats = await self.load_counts(connection, categories)
+        return {
+            'success': True,
+            'categories': category_dict,
+            'question_counts': {id: category['total_questions'] for id,
+                                category in stats['categories'].items()},
+            'total_questions': stats['total_questions']
+        }
+
+    async def get_stats(self, connection, request):
+        categories = await self.load_categories(connection)
+        stats = await self.load_counts(connection, categories)
+        return dict({'success': True}, **stats)
+
+    async def get_questions(self, connection, request):
+        questions, total = await self.paginate(connection, request)
+        if len(questions) == 0:
+            raise HTTPError(404)
+        categories = await self.load_categories(connection)
+        return {
+            'success': True,
+            'questions': questions,
+            'total_questions': total,
+            'categories': [row['type'] for row in categories],
+            'current_category': None
+        }
+
+    async def delete_question(self, connection, request, question_id):
+        deleted = await connection.fetchval(
+            'DELETE FROM questions WHERE id = $1 RETURNING id', question_id)
+        if deleted is None:
+            raise HTTPError(422)
+        self.category_ids.clear()
+        self.dedupe_changed(question_id, None)
+        if request.args.get('return') == 'minimal':
+            return {'success': True, 'deleted': question_id}
+        questions, _ = await self.paginate(connection, request)
+        return {'success': True, 'questions': questions,
+                'deleted': question_id}
+
+    async def create_question(self, connection, request):
+        body = request.get_json()
+        search_term = body.get('searchTerm', None)
+        if search_term:
+            return await self.search_questions(connection, request,
+                                               search_term)
+
+        fields = [body.get(name) for name in
+                  ('question', 'answer', 'category', 'difficulty')]
+        if None in fields:
+            raise HTTPError(400)
+        question_text, answer, category, difficulty = fields
+        try:
+            category = int(category)
+            difficulty = int(difficulty)
+        except (TypeError, ValueError):
+            raise HTTPError(400)
+        if not await connection.fetchval(
+                'SELECT 1 FROM categories WHERE id = $1', category):
+            raise HTTPError(422)
+
+        # a near duplicate of a question of the bank is inserted and
+        # reported, or rejected with DEDUPE='reject' when it has the same
+        # question or answer, like create_app
+        duplicate = None
+        if self.dedupe_mode != 'off':
+            values = signature(question_text, answer)
+            index = await self.load_dedupe_index(connection)
+            duplicate = index.find(values)
+            if (duplicate is not None and self.dedupe_mode == 'reject' and
+                    duplicate[2]):
+                raise HTTPError(409, duplicate_of=duplicate[0])
+
+        question_id = await connection.fetchval(
+            'INSERT INTO questions (question, answer, category, difficulty) '
+            'VALUES ($1, $2, $3, $4) RETURNING id',
+            question_text, answer, category, difficulty)
+        self.category_ids.clear()
+        if self.dedupe_mode != 'off':
+            self.dedupe_changed(question_id, values)
+        created = {'success': True, 'created': question_id,
+                   'question_created': question_text}
+        if duplicate is not None:
+            created['duplicate_of'] = duplicate[0]
+        if request.args.get('return') == 'minimal':
+            return created
+        questions, total = await self.paginate(connection, request)
+        created.update(questions=questions, total_questions=total)
+        return created
+
+    async def load_dedupe_index(self, connection):
+        # the first index is waited for, the next ones are built in the
+        # background every `quiz_ids_ttl` seconds and swapped in
+        loaded = self.dedupe_index
+        if loaded is not None and (time.monotonic() - loaded[0] <
+                                   self.quiz_ids_ttl):
+            return loaded[1]
+        if self.dedupe_build is None:
+            self.dedupe_build = asyncio.ensure_future(
+                self.build_dedupe_index())
+        if loaded is not None:
+            return loaded[1]
+        return await asyncio.shield(self.dedupe_build)
+
+    async def build_dedupe_index(self):
+        # the signatures are computed by a thread, not on the event loop
+        try:
+            async with self.pool.acquire() as connection:
+                rows = await connection.fetch(
+                    'SELECT id, question, answer FROM questions')
+            index = await asyncio.get_running_loop().run_in_executor(
+                None, build_index, rows, self.dedupe_threshold)
+            # the writes made while it was built
+            for question_id, values in self.dedupe_changes:
+                if values is None:
+                    index.remove(question_id)
+                else:
+                    index.add(question_id, values)
+            self.dedupe_index = (time.monotonic(), index)
+            return index
+        finally:
+            self.dedupe_build = None
+            self.dedupe_changes = []
+
+    def dedupe_changed(self, question_id, values):
+        # a question created with its signature, or deleted (None)
+        if self.dedupe_index is not None:
+            if values is None:
+                self.dedupe_index[1].remove(question_id)
+            else:
+                self.dedupe_index[1].add(question_id, values)
+        if self.dedupe_build is not None:
+            self.dedupe_changes.append((question_id, values))
+
+    async def search_questions(self, connection, request, search_term):
+        terms = tokenize(search_term)
+        if not terms:
+            raise HTTPError(404)
+        query = ' & '.join(token + ':*' for token in terms)
+        match = "{} @@ to_tsquery('simple', $1)".format(SEARCH_VECTOR)
+        total = await connection.fetchval(
+            'SELECT count(id) FROM questions WHERE ' + match, query)
+        if total == 0:
+            raise HTTPError(404)
+        page = max(request.arg('page', 1), 1)
+        rows = await connection.fetch(
+            "SELECT {} FROM questions WHERE {} ORDER BY "
+            "ts_rank({}, to_tsquery('simple', $1)) DESC, id "
+            "LIMIT {} OFFSET {}".format(
+                QUESTION_COLUMNS, match, SEARCH_VECTOR, QUESTIONS_PER_PAGE,
+                (page - 1) * QUESTIONS_PER_PAGE), query)
+        return {
+            'success': True,
+            'questions': [format_question(row) for row in rows],
+            'total_questions': total,
+            'current_category': None
+        }
+
+    async def get_questions_by_category(self, connection, request,
+                                        category_id):
+        questions, total = await self.paginate(
+            connection, request, 'category = $1', category_id)
+        if len(questions) == 0:
+            raise HTTPError(404)
+        return {
+            'success': True,
+            'questions': questions,
+            'current_category': category_id,
+            'total_questions': total
+        }
+
+    async def load_category_ids(self, connection, category):
+        # (ids, ids by difficulty) of the category, like QuestionSelector
+        cached = self.category_ids.get(category)
+        if cached is not None and (time.monotonic() - cached[0] <
+                                   self.quiz_ids_ttl):
+            return cached[1]
+        if category == 0:
+            rows = await connection.fetch(
+                'SELECT id, difficulty FROM questions')
+        else:
+            rows = await connection.fetch(
+                'SELECT id, difficulty FROM questions WHERE category = $1',
+                category)
+        loaded = build_buckets((row['id'], row['difficulty'])
+                               for row in rows)
+        self.category_ids[category] = (time.monotonic(), loaded)
+        return loaded
+
+    async def play_quiz(self, connection, request):
+        body = request.get_json()
+        if not ('quiz_category' in body and 'previous_questions' in body):
+            raise HTTPError(400)
+        try:
+            category = int(body['quiz_category']['id'])
+            previous_questions = set(body['previous_questions'])
+            difficulty = body.get('difficulty')
+            if difficulty is not None:
+                difficulty = int(difficulty)
+            streak = max(int(body.get('streak', 0)), 0)
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(400)
+
+        for _ in range(QUIZ_DRAW_ATTEMPTS):
+            ids, buckets = await self.load_category_ids(connection, category)
+            if len(ids) == 0:
+                raise HTTPError(404)
+            draw_difficulty = difficulty
+            if draw_difficulty is None and body.get('adaptive', False):
+                draw_difficulty = target_difficulty(buckets, streak)
+            if draw_difficulty is None:
+                question_id = draw_unseen_id(ids, previous_questions)
+            else:
+                question_id = draw_by_difficulty(buckets, draw_difficulty,
+                                                 previous_questions)
+            if question_id is None:
+                return {'success': True}
+            row = await connection.fetchrow(
+                'SELECT {} FROM questions WHERE id = $1'.format(
+                    QUESTION_COLUMNS), question_id)
+            if row is not None:
+                return {'success': True, 'question': format_question(row)}
+            # deleted by another worker, draw again from fresh ids
+            self.category_ids.pop(category, None)
+        return {'success': True}
+
+    async def play_quiz_batch(self, connection, request):
+        body = request.get_json()
+        if not ('quiz_category' in body and 'previous_questions' in body):
+            raise HTTPError(400)
+        try:
+            category = int(body['quiz_category']['id'])
+            previous_questions = set(body['previous_questions'])
+            count = int(body.get('count', 1))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(400)
+        if not 1 <= count <= QUIZ_BATCH_MAX:
+            raise HTTPError(400)
+
+        ids, _ = await self.load_category_ids(connection, category)
+        if len(ids) == 0:
+            raise HTTPError(404)
+        question_ids = sample_unseen_ids(ids, previous_questions, count)
+        rows = await connection.fetch(
+            'SELECT {} FROM questions WHERE id = ANY($1::int[])'.format(
+                QUESTION_COLUMNS), question_ids)
+        if len(rows) < len(question_ids):
+            # some were deleted by another worker, the next batch draws
+            # from fresh ids
+            self.category_ids.pop(category, None)
+        rows = {row['id']: row for row in rows}
+        return {
+            'success': True,
+            'questions': [format_question(rows[question_id])
+                          for question_id in question_ids
+                          if question_id in rows]
+        }
+
+
+'''
+create_asgi_app(database_url, pool)
+    the ASGI counterpart of create_app, `pool` can be any object with an
+    asyncpg-like acquire() for tests
+'''
+def create_asgi_app(database_url=None, pool=None):
+    return TriviaASGI(database_url, pool)
@@ -0,0 +1,209 @@
+import csv
+import io
+import json
+
+from models import db, Question, Category, question_changed
+from .dedupe import signature
+
+IMPORT_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+# the response only lists the first errors, the count has all of them
+MAX_REPORTED_ERRORS = 100
+FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+
+def decoded_lines(stream, undecodable):
+    # a line that is not UTF-8 is decoded with replacement characters so
+    # the CSV reader keeps its place, and its number added to `undecodable`
+    for line_number, line in enumerate(stream, 1):
+        if isinstance(line, bytes):
+            try:
+                line = line.decode('utf-8')
+            except UnicodeDecodeError:
+                undecodable.add(line_number)
+                line = line.decode('utf-8', 'replace')
+        yield line
+
+
+'''
+read_rows(stream, content_type)
+    yields (line number, row dict) for every row of a NDJSON or CSV body,
+    the row is a ValueError when the line can not be read: not UTF-8, not
+    a JSON object or not valid CSV. the rows after it are still read, the
+    batches before it are already committed.
+'''
+def read_rows(stream, content_type):
+    # the lines read since the last row, they are all part of the next one
+    undecodable = set()
+    lines = decoded_lines(stream, undecodable)
+    if content_type == 'text/csv':
+        reader = csv.DictReader(lines)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                row = ValueError('not valid CSV: {}'.format(error))
+            if undecodable:
+                undecodable.clear()
+                row = ValueError('not UTF-8')
+            yield reader.line_num, row
+    for line_number, line in enumerate(lines, 1):
+        if undecodable:
+            undecodable.clear()
+            yield line_number, ValueError('not UTF-8')
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, (row if isinstance(row, dict) else
+                            ValueError('not a JSON object'))
+
+
+'''
+validate_row(row, category_ids)
+    returns the insertable values of the row or raises ValueError
+'''
+def validate_row(row, category_ids):
+    if isinstance(row, ValueError):
+        raise row
+    missing = [field for field in FIELDS
+               if row.get(field) in (None, '')]
+    if missing:
+        raise ValueError('missing ' + ', '.join(missing))
+    try:
+        category = int(row['category'])
+        difficulty = int(row['difficulty'])
+    except (TypeError, ValueError):
+        raise ValueError('category or difficulty is not a number')
+    if category not in category_ids:
+        raise ValueError('category {} does not exist'.format(category))
+    return {
+        'question': str(row['question']),
+        'answer': str(row['answer']),
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
+def copy_batch(batch):
+    # COPY is much faster than INSERT on postgres, it runs in the
+    # transaction of the session. the ids are taken from the sequence
+    # first, COPY doesn't return them.
+    ids = [question_id for question_id, in db.session.execute(
+        "SELECT nextval(pg_get_serial_sequence('questions', 'id')) "
+        "FROM generate_series(1, :count)", {'count': len(batch)})]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for question_id, row in zip(ids, batch):
+        writer.writerow([question_id] + [row[field] for field in FIELDS])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY questions (id, {}) FROM STDIN WITH '
+                       '(FORMAT csv)'.format(', '.join(FIELDS)), buffer)
+    return ids
+
+
+def insert_batch(batch):
+    # returns the ids of the rows, in their order
+    if db.engine.dialect.name == 'postgresql':
+        ids = copy_batch(batch)
+    else:
+        ids = [db.session.execute(Question.__table__.insert(), row)
+               .inserted_primary_key[0] for row in batch]
+    db.session.commit()
+    question_changed('import', ids)
+    return ids
+
+
+'''
+import_questions(rows, dedupe)
+    validates the (line number, row) pairs one at a time and inserts the
+    valid ones in transactions of IMPORT_BATCH_SIZE rows, the invalid ones
+    are skipped. with a Deduplicator the near duplicates of the bank or of
+    an earlier row are inserted and reported, or skipped as errors with
+    DEDUPE='reject' when they have the same question or answer. returns
+    the number of inserted rows, the errors, their count and the reported
+    duplicates.
+'''
+def import_questions(rows, batch_size=IMPORT_BATCH_SIZE, dedupe=None):
+    inserted = 0
+    errors = []
+    error_count = 0
+    duplicates = []
+    batch = []
+    # the signatures of the rows of the batch
+    signatures = []
+    category_ids = {category_id for category_id,
+                    in db.session.query(Category.id)}
+    index = (dedupe.import_index() if dedupe is not None and dedupe.enabled
+             else None)
+
+    def commit_batch():
+        ids = insert_batch(batch)
+        if index is not None:
+            dedupe.add_imported(zip(ids, signatures))
+        return len(ids)
+
+    for line_number, row in rows:
+        try:
+            values = validate_row(row, category_ids)
+            if index is not None:
+                signatures.append(check_duplicate(
+                    index, dedupe.mode, line_number, values, duplicates))
+            batch.append(values)
+        except ValueError as error:
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'line': line_number, 'message': str(error)})
+            continue
+        if len(batch) == batch_size:
+            inserted += commit_batch()
+            batch = []
+            signatures = []
+    if batch:
+        inserted += commit_batch()
+    return inserted, errors, error_count, duplicates
+
+
+def check_duplicate(index, mode, line_number, values, duplicates):
+    # raises ValueError for a rejected near duplicate, the other rows are
+    # added to the import index under their line number. returns the
+    # signature of the row.
+    values_signature = signature(values['question'], values['answer'])
+    match = index.find(values_signature)
+    if match is not None:
+        key = match[0]
+        message = ('near duplicate of line {}'.format(key[1])
+                   if isinstance(key, tuple) else
+                   'near duplicate of question {}'.format(key))
+        if mode == 'reject' and match[2]:
+            raise ValueError(message)
+        if len(duplicates) < MAX_REPORTED_ERRORS:
+            duplicates.append({'line': line_number, 'message': message})
+    index.add(line_number, values_signature)
+    return values_signature
+
+
+'''
+export_questions()
+    yields the questions table as NDJSON in chunks of EXPORT_BATCH_SIZE
+    lines, the rows are streamed with a server-side cursor
+'''
+def export_questions(batch_size=EXPORT_BATCH_SIZE):
+    rows = db.session.query(
+        Question.id, Question.question, Question.answer, Question.category,
+        Question.difficulty
+    ).order_by(Question.id).execution_options(stream_results=True)
+    lines = []
+    for row in rows.yield_per(batch_size):
+        lines.append(json.dumps(row._asdict()))
+        if len(lines) == batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
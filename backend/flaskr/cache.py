@@ -0,0 +1,220 @@
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from models import add_question_listener
+
+
+'''
+MemoryCache
+    in-process cache backend, entries expire after `ttl` seconds and the
+    least recently used ones are evicted past `max_entries`. with a
+    CatalogWatcher the versions are the shared catalog_version, the same
+    in every worker: the writes of this process move it at once, the
+    writes of the others when the watcher sees them. without one only the
+    writes of this process are seen, for a single process.
+'''
+class MemoryCache:
+
+    def __init__(self, max_entries=1024, ttl=60, watcher=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.watcher = watcher
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.modified = {}
+        # the catalog version after the last write of this process, and
+        # the last one read with the time it was first seen
+        self.written_version = None
+        self.catalog_version = None
+        self.catalog_modified = time.time()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def current_version(self):
+        if self.watcher is None:
+            return None
+        self.watcher.check()
+        versions = [version for version in (self.watcher.version,
+                                            self.written_version)
+                    if version is not None]
+        version = max(versions) if versions else None
+        if version != self.catalog_version:
+            self.catalog_version = version
+            self.catalog_modified = time.time()
+        return version
+
+    def get_generation(self, namespace):
+        generation = self.generations.get(namespace, 0)
+        if self.watcher is None:
+            return generation
+        # the entries of an older catalog version are not read again
+        return '{}.{}'.format(self.current_version(), generation)
+
+    def bump_generation(self, namespace):
+        with self.lock:
+            self.generations[namespace] = (
+                self.generations.get(namespace, 0) + 1)
+            self.modified[namespace] = time.time()
+            # the entries of the old generation can never be read again
+            prefix = namespace + ':'
+            for key in [key for key in self.entries
+                        if key.startswith(prefix)]:
+                del self.entries[key]
+            if self.watcher is not None:
+                # counted here too, a rolled back write leaves the table
+                # behind, else the version written is the larger one
+                self.written_version = max(
+                    self.watcher.load_version() or 0,
+                    (self.written_version or 0) + 1)
+
+    def version(self, namespace):
+        if self.watcher is None:
+            return str(self.get_generation(namespace))
+        return str(self.current_version())
+
+    def last_modified(self, namespace):
+        if self.watcher is None:
+            return self.modified.get(namespace, self.catalog_modified)
+        self.current_version()
+        return self.catalog_modified
+
+
+'''
+RedisCache
+    cache backend shared by the workers through a redis compatible server,
+    values are stored as JSON. `client` only needs get, set and incr.
+'''
+class RedisCache:
+
+    def __init__(self, client, ttl=60, prefix='trivia:cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def get_generation(self, namespace):
+        return int(self.client.get(self.prefix + 'generation:' + namespace)
+                   or 0)
+
+    def bump_generation(self, namespace):
+        self.client.incr(self.prefix + 'generation:' + namespace)
+        self.client.set(self.prefix + 'modified:' + namespace, time.time())
+
+    def version(self, namespace):
+        return str(self.get_generation(namespace))
+
+    def last_modified(self, namespace):
+        modified = self.client.get(self.prefix + 'modified:' + namespace)
+        return None if modified is None else float(modified)
+
+
+'''
+create_cache_backend(app, watcher)
+    builds the backend named by READ_CACHE, 'memory' (the default) or
+    'redis' with READ_CACHE_REDIS_URL, a backend instance can also be
+    given directly in the config
+'''
+def create_cache_backend(app, watcher=None):
+    backend = app.config.get('READ_CACHE', 'memory')
+    ttl = app.config.get('READ_CACHE_TTL', 60)
+    if backend == 'memory':
+        return MemoryCache(app.config.get('READ_CACHE_MAX', 1024), ttl,
+                           watcher)
+    if backend == 'redis':
+        import redis
+        client = redis.Redis.from_url(
+            app.config.get('READ_CACHE_REDIS_URL', 'redis://localhost'))
+        return RedisCache(client, ttl)
+    return backend
+
+
+'''
+ReadCache
+    read-through cache of the read endpoints payloads. keys are grouped in
+    namespaces, a namespace is invalidated by bumping its generation, and
+    the 'questions' namespace is invalidated by Question.insert()/delete().
+    values must be JSON serializable and never None. with a Catalog the
+    versions also name the snapshot served: a write moves the version of
+    the cache at once, the snapshot is swapped in later and moves it
+    again, so a response of the previous rows never keeps the new ETag.
+'''
+class ReadCache:
+
+    def __init__(self, app, backend=None, watcher=None, catalog=None):
+        if backend is None:
+            backend = create_cache_backend(app, watcher)
+        self.backend = backend
+        self.catalog = catalog
+        self.hits = 0
+        self.misses = 0
+        app.extensions['read_cache'] = self
+        add_question_listener(app, self.question_changed)
+
+    def question_changed(self, action, question):
+        self.invalidate('questions')
+
+    def invalidate(self, namespace):
+        self.backend.bump_generation(namespace)
+
+    def key(self, namespace, *parts):
+        return ':'.join([namespace, str(self.backend.get_generation(
+            namespace))] + [str(part) for part in parts])
+
+    def get_or_load(self, namespace, parts, loader):
+        key = self.key(namespace, *parts)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = loader()
+        self.backend.set(key, value)
+        return value
+
+    def version(self, namespace):
+        # changes whenever the cached values of the namespace may change
+        version = self.backend.version(namespace)
+        if self.catalog is None:
+            return version
+        return '{}.{}'.format(version, self.catalog.current().version)
+
+    def last_modified(self, namespace):
+        modified = self.backend.last_modified(namespace)
+        if self.catalog is None or modified is None:
+            return modified
+        self.catalog.current()
+        # rounded up, Last-Modified has whole seconds: a response of the
+        # previous snapshot in the second of the swap is older than it
+        return max(modified, math.ceil(self.catalog.refreshed_at))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,309 @@
+import bisect
+import logging
+import os
+import select
+import sys
+import threading
+import time
+
+from models import db, Question, Category, CatalogVersion, \
+    add_question_listener
+from .pagination import QUESTIONS_PER_PAGE
+from .metrics import render_counter
+from .quiz import build_buckets
+from .serialization import QUESTION_COLUMNS, format_rows
+
+CATALOG_POLL_INTERVAL = 2.0
+NOTIFY_CHANNEL = 'trivia_catalog'
+
+logger = logging.getLogger(__name__)
+
+
+def deep_size(value, seen=None):
+    # bytes of the value and everything it holds
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen)
+                    for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in value)
+    return size
+
+
+'''
+CatalogWatcher
+    the version of catalog_version, shared by the workers: it moves with
+    every write of questions or categories, by any worker. it's checked
+    every CATALOG_POLL_INTERVAL seconds when an index is read
+    (CATALOG_REFRESH='poll', None never checks it) or notified by postgres
+    (CATALOG_REFRESH='notify'). the in-memory indexes of the tables add
+    their reload with on_change(), a background thread of the worker calls
+    them when the version moved while the requests keep reading the
+    previous index. changed(reload) runs one of them after a write of
+    this worker.
+'''
+class CatalogWatcher:
+
+    def __init__(self, app):
+        self.app = app
+        self.mode = app.config.get('CATALOG_REFRESH', 'poll')
+        self.poll_interval = app.config.get('CATALOG_POLL_INTERVAL',
+                                            CATALOG_POLL_INTERVAL)
+        self.version = None
+        self.checked_at = 0.0
+        self.reloads = []
+        # the reloads to run on the next wakeup of the thread
+        self.pending = set()
+        self.listener_pid = None
+        self.reloader_pid = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        app.extensions['catalog_watcher'] = self
+
+    def on_change(self, reload):
+        self.reloads.append(reload)
+
+    def load_version(self):
+        return db.session.query(CatalogVersion.version).filter(
+            CatalogVersion.id == 1).scalar()
+
+    def start(self):
+        # the version the indexes loaded before the workers fork are at
+        if self.version is None:
+            self.version = self.load_version()
+
+    def check(self):
+        # called in an app context before an index is read
+        if self.mode == 'notify':
+            self.start_listener()
+            return
+        if (self.poll_interval is None or
+                time.monotonic() - self.checked_at < self.poll_interval):
+            return
+        self.checked_at = time.monotonic()
+        self.moved_to(self.load_version())
+
+    def moved_to(self, version):
+        if version == self.version:
+            return
+        known = self.version is not None
+        self.version = version
+        if known:
+            self.schedule(self.reloads)
+
+    def changed(self, reload):
+        self.schedule([reload])
+
+    def schedule(self, reloads):
+        with self.lock:
+            self.pending.update(reloads)
+        self.start_reloader()
+        self.wakeup.set()
+
+    def start_reloader(self):
+        # one thread per process, the workers forked after create_app
+        # start their own
+        if self.reloader_pid == os.getpid():
+            return
+        with self.lock:
+            if self.reloader_pid == os.getpid():
+                return
+            self.reloader_pid = os.getpid()
+            threading.Thread(target=self.reload_all, daemon=True).start()
+
+    def reload_all(self):
+        while True:
+            # the versions moved while reloading make one more reload
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                pending, self.pending = self.pending, set()
+            with self.app.app_context():
+                for reload in [reload for reload in self.reloads
+                               if reload in pending]:
+                    try:
+                        reload()
+                    except Exception:
+                        logger.exception('%r not reloaded', reload)
+
+    def start_listener(self):
+        if self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.listener_pid = os.getpid()
+            threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        with self.app.app_context():
+            engine = db.get_engine()
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                # the connection stays LISTENing, it's not given back
+                connection.detach()
+                connection.connection.set_isolation_level(0)
+                cursor = connection.cursor()
+                cursor.execute('LISTEN ' + NOTIFY_CHANNEL)
+                # changes missed while (re)connecting
+                cursor.execute('SELECT version FROM catalog_version '
+                               'WHERE id = 1')
+                self.moved_to(cursor.fetchone()[0])
+                while True:
+                    if select.select([connection.connection], [], [],
+                                     60) == ([], [], []):
+                        continue
+                    connection.connection.poll()
+                    notifies = connection.connection.notifies
+                    if notifies:
+                        version = int(notifies[-1].payload)
+                        del notifies[:]
+                        self.moved_to(version)
+            except Exception:
+                logger.exception('catalog listener failed, reconnecting')
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(self.poll_interval or CATALOG_POLL_INTERVAL)
+
+
+'''
+CatalogSnapshot
+    the questions and categories at one version, never changed after it's
+    built: rows by id, sorted ids by category (0 is all the questions) and
+    ids by category and difficulty
+'''
+class CatalogSnapshot:
+
+    def __init__(self, version, categories, rows):
+        self.version = version
+        self.categories = categories
+        self.rows = {}
+        pairs = {0: []}
+        for row in rows:
+            row = tuple(row)
+            self.rows[row[0]] = row
+            for category in (0, row[3]):
+                pairs.setdefault(category, []).append((row[0], row[4]))
+        # the rows are ordered by id, so are the ids
+        self.ids = {}
+        self.buckets = {}
+        for category, category_pairs in pairs.items():
+            self.ids[category], self.buckets[category] = build_buckets(
+                category_pairs)
+
+
+'''
+Catalog
+    the questions and categories kept in memory by every worker, enabled
+    with CATALOG. it's loaded by create_app, then a new snapshot is built
+    by the thread of the CatalogWatcher when catalog_version moves or after
+    a write of this worker, and swapped in: the requests keep reading the
+    previous one meanwhile, and never wait for a load.
+'''
+class Catalog:
+
+    def __init__(self, app, watcher):
+        self.watcher = watcher
+        self.snapshot = None
+        self.refreshes = 0
+        self.refresh_seconds = 0.0
+        # when the snapshot was swapped in
+        self.refreshed_at = 0.0
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        app.extensions['catalog'] = self
+        add_question_listener(app, self.question_changed)
+        watcher.on_change(self.refresh)
+
+    def question_changed(self, action, question):
+        self.watcher.changed(self.refresh)
+
+    def refresh(self):
+        # one load at a time, the readers don't take the lock
+        with self.lock:
+            start = time.perf_counter()
+            version = self.watcher.load_version()
+            categories = [[category_id, category_type] for category_id,
+                          category_type in db.session.query(
+                              Category.id, Category.type).order_by(
+                              Category.id)]
+            rows = db.session.query(*QUESTION_COLUMNS).order_by(
+                Question.id).yield_per(10000)
+            snapshot = CatalogSnapshot(version, categories, rows)
+            self.memory_bytes = deep_size(snapshot.__dict__)
+            self.snapshot = snapshot
+            self.refreshed_at = time.time()
+            self.refresh_seconds = time.perf_counter() - start
+            self.refreshes += 1
+        logger.info('catalog version %s loaded: %d questions, %d bytes, '
+                    '%.1f ms', version, len(snapshot.rows),
+                    self.memory_bytes, self.refresh_seconds * 1000)
+
+    def current(self):
+        # the snapshot to read, a newer one is loaded in the background
+        self.watcher.check()
+        if self.snapshot is None:
+            # not loaded by create_app, the database was unavailable
+            self.refresh()
+        return self.snapshot
+
+    def categories(self):
+        return self.current().categories
+
+    def category_buckets(self, category):
+        snapshot = self.current()
+        return (snapshot.ids.get(category, []),
+                snapshot.buckets.get(category, {}))
+
+    def question(self, question_id):
+        return self.current().rows.get(question_id)
+
+    def page(self, category, page=1, after_id=None):
+        # the same page as pagination() of the category, from memory
+        snapshot = self.current()
+        ids = snapshot.ids.get(category, [])
+        if after_id is not None:
+            start = bisect.bisect_right(ids, after_id)
+        else:
+            start = (page - 1) * QUESTIONS_PER_PAGE
+        page_ids = ids[start:start + QUESTIONS_PER_PAGE]
+        return {
+            'questions': format_rows(snapshot.rows[question_id]
+                                     for question_id in page_ids),
+            'total_questions': len(ids)
+        }
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            'version': snapshot.version if snapshot else None,
+            'questions': len(snapshot.rows) if snapshot else 0,
+            'memory_bytes': self.memory_bytes,
+            'refresh_seconds': self.refresh_seconds,
+            'refreshes': self.refreshes
+        }
+
+    def render(self):
+        stats = self.stats()
+        lines = []
+        lines += render_counter('trivia_catalog_questions',
+                                'Questions in the catalog.',
+                                stats['questions'], 'gauge')
+        lines += render_counter('trivia_catalog_memory_bytes',
+                                'Approximate memory of the catalog.',
+                                stats['memory_bytes'], 'gauge')
+        lines += render_counter('trivia_catalog_refresh_seconds',
+                                'Duration of the last catalog load.',
+                                stats['refresh_seconds'], 'gauge')
+        lines += render_counter('trivia_catalog_refreshes_total',
+                                'Catalog loads.', stats['refreshes'])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,69 @@
+import gzip
+
+from flask import request
+
+from .metrics import timing
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bytes, smaller bodies are not worth the CPU
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+'''
+Compression
+    compresses the JSON responses of at least COMPRESS_MIN_SIZE bytes with
+    brotli (when it's installed) or gzip, whichever the Accept-Encoding of
+    the request prefers. the ETag of a compressed response is made weak,
+    it still matches If-None-Match. a 304 has the Vary header of the 200
+    it stands for, so a shared cache keeps one copy per encoding.
+    COMPRESS_GZIP_LEVEL (6) and COMPRESS_BROTLI_QUALITY (4) trade the CPU
+    for the ratio.
+'''
+class Compression:
+
+    def __init__(self, app):
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE)
+        self.levels = {
+            'gzip': app.config.get('COMPRESS_GZIP_LEVEL', 6),
+            'br': app.config.get('COMPRESS_BROTLI_QUALITY', 4)
+        }
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        app.after_request(self.after_request)
+        app.extensions['compression'] = self
+
+    def after_request(self, response):
+        if response.status_code == 304:
+            response.vary.add('Accept-Encoding')
+            return response
+        if (response.status_code != 200 or response.direct_passthrough or
+                response.is_streamed or
+                response.mimetype not in COMPRESS_MIMETYPES or
+                'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        with timing('compress'):
+            response.set_data(compress(data, encoding,
+                                       self.levels[encoding]))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,44 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+
+from flask import request, make_response
+from werkzeug.http import is_resource_modified
+
+
+'''
+conditional(cache, *namespaces)
+    decorates a GET view of a collection with an ETag and a Last-Modified
+    made from the versions of the read cache namespaces it depends on.
+    a request with a matching If-None-Match (or If-Modified-Since) is
+    answered with 304 before the view runs, so without any query or
+    serialization.
+'''
+def conditional(cache, *namespaces):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = hashlib.sha1(':'.join(
+                cache.version(namespace) for namespace in namespaces
+            ).encode()).hexdigest()[:16]
+            modified = [cache.last_modified(namespace)
+                        for namespace in namespaces]
+            last_modified = None
+            if None not in modified:
+                last_modified = datetime.utcfromtimestamp(int(max(modified)))
+
+            if not is_resource_modified(request.environ, etag=etag,
+                                        last_modified=last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # let the clients store the response but check it every time
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
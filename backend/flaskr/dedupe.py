@@ -0,0 +1,293 @@
+import threading
+import zlib
+from array import array
+
+from models import db, Question, add_question_listener
+from .suggest import normalize
+
+# estimated Jaccard similarity of two questions above which the newest is
+# a near duplicate. questions that only differ by a number or a word
+# ("World War I" and "World War II") score up to 0.85 or so, so a near
+# duplicate is only rejected when its question or its answer is the same
+DEDUPE_THRESHOLD = 0.8
+SHINGLE_SIZE = 4
+# 16 bands of 4 hashes, a pair of 0.8 similar questions shares a band
+# with a probability of 0.9998 and a pair of 0.3 similar ones of 0.12
+PERMUTATIONS = 64
+BAND_ROWS = 4
+DEDUPE_BATCH_SIZE = 1000
+
+# one permutation hashing: the top 6 bits of a shingle hash pick one of
+# the 64 bins, the other 58 are its value in the bin
+BIN_BITS = 58
+VALUE_MASK = (1 << BIN_BITS) - 1
+HASH_MASK = (1 << 64) - 1
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+EMPTY = HASH_MASK
+
+
+'''
+shingles(text)
+    the hashed character SHINGLE_SIZE-grams of the normalized text
+'''
+def shingles(text):
+    text = normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text.encode())}
+    return {zlib.crc32(text[start:start + SHINGLE_SIZE].encode())
+            for start in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+'''
+signature(question, answer)
+    the MinHash of the question and its answer, the answer tells apart
+    questions that only differ by a word like "the capital of France"
+    and "the capital of Spain". every shingle is hashed once into one of
+    PERMUTATIONS bins (one permutation hashing), instead of once per
+    permutation, and an empty bin takes the value of the next filled one.
+    the PERMUTATIONS values are followed by the hashes of the normalized
+    question and answer, that confirm a near duplicate.
+'''
+def signature(question, answer=''):
+    bins = [EMPTY] * PERMUTATIONS
+    for value in shingles('{} {}'.format(question, answer)):
+        value = (value * HASH_MULTIPLIER) & HASH_MASK
+        position = value >> BIN_BITS
+        if value & VALUE_MASK < bins[position]:
+            bins[position] = value & VALUE_MASK
+    filled = list(bins)
+    for position, value in enumerate(bins):
+        distance = 1
+        while value == EMPTY:
+            value = bins[(position + distance) % PERMUTATIONS]
+            if value != EMPTY:
+                # shifted, so the bins it fills don't all look alike
+                value += distance << BIN_BITS
+            distance += 1
+        filled[position] = value
+    filled.append(zlib.crc32(normalize(question).encode()))
+    filled.append(zlib.crc32(normalize(answer).encode()))
+    return array('Q', filled)
+
+
+def similarity(first, second):
+    return sum(1 for x, y in zip(first[:PERMUTATIONS],
+                                 second[:PERMUTATIONS])
+               if x == y) / PERMUTATIONS
+
+
+def is_confirmed(first, second):
+    # the same normalized question or the same normalized answer
+    return any(x == y for x, y in zip(first[PERMUTATIONS:],
+                                      second[PERMUTATIONS:]))
+
+
+def rank(match):
+    # the confirmed (key, similarity, confirmed) matches first
+    return match[2], match[1]
+
+
+def band_keys(values):
+    return [hash(tuple(values[start:start + BAND_ROWS]))
+            for start in range(0, PERMUTATIONS, BAND_ROWS)]
+
+
+'''
+MinHashIndex
+    locality sensitive hashing of the question signatures: the signatures
+    sharing a band are the candidates of a lookup, only they are compared,
+    not every question
+'''
+class MinHashIndex:
+
+    def __init__(self, threshold=DEDUPE_THRESHOLD):
+        self.threshold = threshold
+        self.signatures = {}
+        self.bands = [{} for _ in range(PERMUTATIONS // BAND_ROWS)]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def add(self, key, values):
+        with self.lock:
+            self._remove(key)
+            self.signatures[key] = values
+            for band, band_key in zip(self.bands, band_keys(values)):
+                band.setdefault(band_key, []).append(key)
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        values = self.signatures.pop(key, None)
+        if values is None:
+            return
+        for band, band_key in zip(self.bands, band_keys(values)):
+            keys = band[band_key]
+            keys.remove(key)
+            if not keys:
+                del band[band_key]
+
+    def find(self, values):
+        # (key, similarity, confirmed) of the most similar signature over
+        # the threshold, the confirmed ones first, or None
+        with self.lock:
+            candidates = set()
+            for band, band_key in zip(self.bands, band_keys(values)):
+                candidates.update(band.get(band_key, ()))
+            best = None
+            for key in candidates:
+                score = similarity(values, self.signatures[key])
+                if score < self.threshold:
+                    continue
+                match = (key, score,
+                         is_confirmed(values, self.signatures[key]))
+                if best is None or rank(match) > rank(best):
+                    best = match
+        return best
+
+
+'''
+build_index(rows, threshold)
+    the MinHashIndex of the (id, question, answer) rows
+'''
+def build_index(rows, threshold=DEDUPE_THRESHOLD):
+    index = MinHashIndex(threshold)
+    for question_id, text, answer in rows:
+        index.add(question_id, signature(text, answer))
+    return index
+
+
+'''
+ImportIndex
+    the near duplicate lookups of a bulk import: the rows of the import
+    are indexed by line number apart from the shared index of the bank,
+    which only gets them with their ids once their batch is committed
+'''
+class ImportIndex:
+
+    def __init__(self, shared, threshold=DEDUPE_THRESHOLD):
+        self.shared = shared
+        self.lines = MinHashIndex(threshold)
+
+    def find(self, values):
+        matches = [match for match in (self.shared.find(values),
+                                       self.lines.find(values))
+                   if match is not None]
+        return max(matches, key=rank) if matches else None
+
+    def add(self, line_number, values):
+        self.lines.add(('line', line_number), values)
+
+
+'''
+Deduplicator
+    checks the new questions of POST /questions and of the bulk import
+    against a MinHashIndex of the questions table, built on first use (or
+    by wsgi.py before the workers fork) and kept current by
+    Question.insert()/delete() and the committed batches of the imports.
+    the writes of the other workers move the catalog version, the index is
+    then built again in the background and swapped in. DEDUPE is 'flag'
+    (the default) to insert them and report the duplicate, 'reject' to
+    refuse the confirmed ones, with the same question or answer, or 'off'.
+'''
+class Deduplicator:
+
+    def __init__(self, app, watcher):
+        self.mode = app.config.get('DEDUPE', 'flag')
+        self.threshold = app.config.get('DEDUPE_THRESHOLD', DEDUPE_THRESHOLD)
+        self.watcher = watcher
+        self.index = None
+        self.lock = threading.Lock()
+        app.extensions['dedupe'] = self
+        add_question_listener(app, self.question_changed)
+        watcher.on_change(self.reload)
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def build(self):
+        rows = db.session.query(Question.id, Question.question,
+                                Question.answer)
+        return build_index(rows.yield_per(DEDUPE_BATCH_SIZE),
+                           self.threshold)
+
+    def load(self):
+        self.watcher.check()
+        with self.lock:
+            if self.index is None:
+                self.index = self.build()
+        return self.index
+
+    def reload(self):
+        # the index of the current rows, swapped in once it's built
+        if self.index is not None:
+            self.index = self.build()
+
+    def question_changed(self, action, question):
+        index = self.index
+        if index is None:
+            return
+        if action == 'insert':
+            index.add(question.id, signature(question.question,
+                                             question.answer))
+        elif action == 'delete':
+            index.remove(question.id)
+        elif action == 'bulk':
+            # build the index again on next use
+            self.index = None
+
+    def add_imported(self, rows):
+        # the (id, signature) of the rows of a committed import batch
+        index = self.index
+        if index is None:
+            return
+        for question_id, values in rows:
+            index.add(question_id, values)
+
+    def import_index(self):
+        # the index of a new bulk import
+        return ImportIndex(self.load(), self.threshold)
+
+    def rejects(self, duplicate):
+        return (duplicate is not None and self.mode == 'reject' and
+                duplicate[2])
+
+    def find(self, question, answer):
+        # (id, similarity, confirmed) of a near duplicate of the question,
+        # or None
+        if not self.enabled:
+            return None
+        return self.load().find(signature(question, answer))
+
+
+'''
+find_duplicates(rows, threshold)
+    yields (id, duplicate of id, similarity, confirmed) for every (id,
+    question, answer) row that is a near duplicate of an earlier one
+'''
+def find_duplicates(rows, threshold=DEDUPE_THRESHOLD):
+    index = MinHashIndex(threshold)
+    for question_id, text, answer in rows:
+        values = signature(text, answer)
+        match = index.find(values)
+        if match is not None:
+            yield (question_id,) + match
+        else:
+            index.add(question_id, values)
+
+
+'''
+scan_duplicates(threshold, batch_size)
+    find_duplicates() of the questions table, oldest first, streamed with
+    a server-side cursor in batches of `batch_size` rows
+'''
+def scan_duplicates(threshold=DEDUPE_THRESHOLD,
+                    batch_size=DEDUPE_BATCH_SIZE):
+    rows = db.session.query(
+        Question.id, Question.question, Question.answer
+    ).order_by(Question.id).execution_options(stream_results=True)
+    return find_duplicates(rows.yield_per(batch_size), threshold)
@@ -0,0 +1,193 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, g, request
+
+# the limits of the expensive requests, per endpoint name. `rate` tokens
+# per second and client up to `burst`, and at most `concurrency` of them
+# in flight per worker, the others wait `queue_timeout` seconds for a slot.
+# 'search_questions' is the search branch of POST /questions. every new
+# quiz session or room takes a slot of the session store, their rate keeps
+# one client from evicting the sessions of the others.
+DEFAULT_LIMITS = {
+    'play_quiz': {'rate': 10, 'burst': 20, 'concurrency': 16,
+                  'queue_timeout': 2.0},
+    'play_quiz_batch': {'rate': 2, 'burst': 5, 'concurrency': 16,
+                        'queue_timeout': 2.0},
+    'search_questions': {'rate': 5, 'burst': 10, 'concurrency': 8,
+                         'queue_timeout': 2.0},
+    'start_quiz_session': {'rate': 1, 'burst': 10},
+    'open_room': {'rate': 0.2, 'burst': 5}
+}
+
+
+'''
+MemoryRateStore
+    in-process token buckets, the least recently used buckets are dropped
+    past `max_keys` (a dropped bucket is full again)
+'''
+class MemoryRateStore:
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # returns 0 when a token was taken, or the seconds until the
+        # next one
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+'''
+RedisRateStore
+    token buckets shared by the workers through a redis compatible server,
+    a bucket is updated atomically by a lua script
+'''
+class RedisRateStore:
+
+    SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - last, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'time', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+    def __init__(self, client, prefix='trivia:rate:'):
+        self.client = client
+        self.prefix = prefix
+        self.script = client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self.script(keys=[self.prefix + key],
+                                 args=[rate, burst, time.time()]))
+
+
+'''
+create_rate_store(app)
+    builds the store named by RATE_LIMIT_STORE, 'memory' (the default) or
+    'redis' with RATE_LIMIT_REDIS_URL, a store instance can also be given
+    directly in the config
+'''
+def create_rate_store(app):
+    store = app.config.get('RATE_LIMIT_STORE', 'memory')
+    if store == 'memory':
+        return MemoryRateStore()
+    if store == 'redis':
+        import redis
+        client = redis.Redis.from_url(
+            app.config.get('RATE_LIMIT_REDIS_URL', 'redis://localhost'))
+        return RedisRateStore(client)
+    return store
+
+
+def limit_name(request):
+    if (request.endpoint == 'create_question' and
+            (request.get_json(silent=True) or {}).get('searchTerm')):
+        return 'search_questions'
+    return request.endpoint
+
+
+'''
+Admission
+    admission control of the endpoints named in RATE_LIMITS (merged over
+    DEFAULT_LIMITS, a limit set to None is removed). a client over its
+    rate gets 429 and a request that found no free slot in time gets 503,
+    both with a Retry-After header. clients are told apart by their
+    address, the first X-Forwarded-For one with RATE_LIMIT_TRUST_PROXY.
+'''
+class Admission:
+
+    def __init__(self, app, store=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(app.config.get('RATE_LIMITS', {}))
+        self.limits = {name: limit for name, limit in self.limits.items()
+                       if limit is not None}
+        self.store = create_rate_store(app) if store is None else store
+        self.trust_proxy = app.config.get('RATE_LIMIT_TRUST_PROXY', False)
+        self.slots = {name: threading.BoundedSemaphore(limit['concurrency'])
+                      for name, limit in self.limits.items()
+                      if limit.get('concurrency')}
+        self.rejections = {}
+        self.lock = threading.Lock()
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.extensions['admission'] = self
+
+    def client(self):
+        if self.trust_proxy and request.access_route:
+            return request.access_route[0]
+        return request.remote_addr or 'unknown'
+
+    def reject(self, name, status, retry_after):
+        with self.lock:
+            key = (name, status)
+            self.rejections[key] = self.rejections.get(key, 0) + 1
+        g.retry_after = max(int(math.ceil(retry_after)), 1)
+        abort(status)
+
+    def before_request(self):
+        name = limit_name(request)
+        limit = self.limits.get(name)
+        if limit is None:
+            return
+        if limit.get('rate'):
+            wait = self.store.take('{}:{}'.format(name, self.client()),
+                                   limit['rate'],
+                                   limit.get('burst', limit['rate']))
+            if wait > 0:
+                self.reject(name, 429, wait)
+        slots = self.slots.get(name)
+        if slots is not None:
+            timeout = limit.get('queue_timeout', 0)
+            if not slots.acquire(timeout=timeout):
+                self.reject(name, 503, max(timeout, 1))
+            g.admission_slot = slots
+
+    def after_request(self, response):
+        if 'retry_after' in g:
+            response.headers['Retry-After'] = str(g.retry_after)
+        return response
+
+    def teardown_request(self, exception):
+        slots = g.pop('admission_slot', None)
+        if slots is not None:
+            slots.release()
+
+    def render(self):
+        lines = ['# HELP trivia_admission_rejections_total Requests '
+                 'rejected by the rate (429) or concurrency (503) limits.',
+                 '# TYPE trivia_admission_rejections_total counter']
+        with self.lock:
+            for (name, status), count in sorted(self.rejections.items()):
+                lines.append('trivia_admission_rejections_total{{limit="{}",'
+                             'status="{}"}} {}'.format(name, status, count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,219 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, has_request_context, \
+    request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import pool_metrics
+from .serialization import FastJSONEncoder
+
+# seconds, from a cached page to a slow quiz draw
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50)
+SLOW_QUERY_MS = 200
+
+slow_query_logger = logging.getLogger('flaskr.slow_queries')
+
+
+'''
+Histogram
+    a Prometheus histogram with one series per label values
+'''
+class Histogram:
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = {
+                    'counts': [0] * len(self.buckets), 'sum': 0.0,
+                    'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = ','.join('{}="{}"'.format(name, value) for name,
+                                  value in zip(self.labels, label_values))
+                for bound, count in zip(self.buckets, series['counts']):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        self.name, labels, bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    self.name, labels, series['count']))
+                lines.append('{}_sum{{{}}} {}'.format(
+                    self.name, labels, series['sum']))
+                lines.append('{}_count{{{}}} {}'.format(
+                    self.name, labels, series['count']))
+        return lines
+
+
+def render_counter(name, description, value, kind='counter'):
+    return ['# HELP {} {}'.format(name, description),
+            '# TYPE {} {}'.format(name, kind),
+            '{} {}'.format(name, value)]
+
+
+'''
+timing(phase)
+    adds the time spent in the block to the `phase` timing of the current
+    request, 'serialize' is reported by the metrics
+'''
+@contextmanager
+def timing(phase):
+    if not has_request_context() or 'request_timings' not in g:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.request_timings[phase] = (g.request_timings.get(phase, 0.0) +
+                                    time.perf_counter() - start)
+
+
+class TimedJSONEncoder(FastJSONEncoder):
+
+    def encode(self, o):
+        with timing('serialize'):
+            return super().encode(o)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and 'request_timings' in g:
+        g.request_timings['db'] = g.request_timings.get('db', 0.0) + elapsed
+        g.request_queries += 1
+    if has_app_context():
+        threshold = current_app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS)
+        if threshold is not None and elapsed * 1000 >= threshold:
+            slow_query_logger.warning('slow query (%.1f ms): %s %r',
+                                      elapsed * 1000, statement, parameters)
+
+
+'''
+RequestMetrics
+    records the SQL queries, the database time, the JSON serialization
+    time and the total time of every request per route. they are sent in
+    a Server-Timing header (unless SERVER_TIMING is False) and rendered
+    for Prometheus by render(). queries slower than SLOW_QUERY_MS are
+    logged on the 'flaskr.slow_queries' logger.
+'''
+class RequestMetrics:
+
+    def __init__(self, app):
+        self.server_timing = app.config.get('SERVER_TIMING', True)
+        labels = ('route', 'method')
+        self.durations = Histogram(
+            'trivia_request_duration_seconds',
+            'Total time of the requests.', labels, DURATION_BUCKETS)
+        self.db_durations = Histogram(
+            'trivia_request_db_seconds',
+            'Time of the requests spent in SQL queries.', labels,
+            DURATION_BUCKETS)
+        self.serialize_durations = Histogram(
+            'trivia_request_serialize_seconds',
+            'Time of the requests spent serializing JSON.', labels,
+            DURATION_BUCKETS)
+        self.queries = Histogram(
+            'trivia_request_queries',
+            'SQL queries run by the requests.', labels, QUERY_BUCKETS)
+        self.responses = {}
+        self.lock = threading.Lock()
+        app.json_encoder = TimedJSONEncoder
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.extensions['request_metrics'] = self
+
+    def before_request(self):
+        g.request_start = time.perf_counter()
+        g.request_timings = {}
+        g.request_queries = 0
+
+    def after_request(self, response):
+        if 'request_start' not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        db_time = g.request_timings.get('db', 0.0)
+        serialize_time = g.request_timings.get('serialize', 0.0)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = (route, request.method)
+        self.durations.observe(labels, total)
+        self.db_durations.observe(labels, db_time)
+        self.serialize_durations.observe(labels, serialize_time)
+        self.queries.observe(labels, g.request_queries)
+        with self.lock:
+            key = labels + (str(response.status_code),)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+        if self.server_timing:
+            timings = [
+                'db;dur={:.3f};desc="{} queries"'.format(
+                    db_time * 1000, g.request_queries),
+                'serialize;dur={:.3f}'.format(serialize_time * 1000)]
+            timings += ['{};dur={:.3f}'.format(phase, duration * 1000)
+                        for phase, duration in g.request_timings.items()
+                        if phase not in ('db', 'serialize')]
+            timings.append('total;dur={:.3f}'.format(total * 1000))
+            response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def render(self, cache=None):
+        lines = []
+        for histogram in (self.durations, self.db_durations,
+                          self.serialize_durations, self.queries):
+            lines += histogram.render()
+        lines += ['# HELP trivia_responses_total Responses sent.',
+                  '# TYPE trivia_responses_total counter']
+        with self.lock:
+            for (route, method, status), count in sorted(
+                    self.responses.items()):
+                lines.append('trivia_responses_total{{route="{}",method="{}",'
+                             'status="{}"}} {}'.format(route, method, status,
+                                                       count))
+        if cache is not None:
+            stats = cache.stats()
+            lines += render_counter('trivia_read_cache_hits_total',
+                                    'Read cache hits.', stats['hits'])
+            lines += render_counter('trivia_read_cache_misses_total',
+                                    'Read cache misses.', stats['misses'])
+        pool = pool_metrics.snapshot()
+        lines += render_counter('trivia_db_pool_checkouts_total',
+                                'Connections checked out of the pool.',
+                                pool['checkouts'])
+        lines += render_counter('trivia_db_pool_wait_seconds_total',
+                                'Time spent waiting for a connection.',
+                                pool['wait_seconds'])
+        lines += render_counter('trivia_db_pool_max_wait_seconds',
+                                'Longest wait for a connection.',
+                                pool['max_wait_seconds'], 'gauge')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,77 @@
+from sqlalchemy import func
+
+from models import Question
+from .metrics import timing
+from .serialization import question_rows, format_rows, columnar
+
+QUESTIONS_PER_PAGE = 10
+
+
+'''
+page_args(request)
+    reads the paging arguments of the request, `page` for offset paging
+    and `after_id` for keyset paging (the id of the last question the
+    client has already seen)
+'''
+def page_args(request):
+    page = request.args.get('page', 1, type=int)
+    after_id = request.args.get('after_id', None, type=int)
+    return max(page, 1), after_id
+
+
+'''
+wants_minimal(request)
+    true when a write asks for `?return=minimal`, the response then only
+    has the id of the question instead of the current page
+'''
+def wants_minimal(request):
+    return request.args.get('return') == 'minimal'
+
+
+'''
+shape_questions(request, questions)
+    the formatted questions in the format asked by the request, a list
+    of objects or, with `?format=columnar`, an object of arrays
+'''
+def shape_questions(request, questions):
+    if request.args.get('format') == 'columnar':
+        return columnar(questions)
+    return questions
+
+
+'''
+count_questions(query)
+    returns the number of rows matched by the query with a single
+    COUNT, without loading any of them
+'''
+def count_questions(query):
+    return query.order_by(None).with_entities(
+        func.count(Question.id)).scalar()
+
+
+'''
+page_questions(query, page, after_id)
+    loads only the requested page of the query using LIMIT/OFFSET,
+    or `WHERE id > after_id ... LIMIT` when a keyset cursor is given
+'''
+def page_questions(query, page=1, after_id=None):
+    query = query.order_by(Question.id)
+    if after_id is not None:
+        query = query.filter(Question.id > after_id)
+    else:
+        query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+    return query.limit(QUESTIONS_PER_PAGE).all()
+
+
+'''
+pagination(request, query)
+    returns the formatted questions of the current page and the
+    total number of questions matched by the query, the page is
+    selected as plain rows
+'''
+def pagination(request, query):
+    page, after_id = page_args(request)
+    rows = page_questions(question_rows(query), page, after_id)
+    with timing('serialize'):
+        formatted_questions = format_rows(rows)
+    return formatted_questions, count_questions(query)
@@ -0,0 +1,199 @@
+import random
+import threading
+import time
+
+from models import db, Question, add_question_listener
+from .serialization import load_question_row, load_question_rows
+
+# random draws tried before falling back to filtering the unseen ids
+SAMPLE_ATTEMPTS = 8
+# the most questions of a POST /quizzes/batch
+QUIZ_BATCH_MAX = 50
+# right answers in a row before an adaptive quiz gets harder
+QUIZ_STREAK_STEP = 2
+
+
+'''
+draw_unseen_id(ids, previous_ids)
+    returns a random id of `ids` that is not in the `previous_ids` set,
+    or None when all of them have been played
+'''
+def draw_unseen_id(ids, previous_ids):
+    if not ids:
+        return None
+    for _ in range(SAMPLE_ATTEMPTS):
+        question_id = random.choice(ids)
+        if question_id not in previous_ids:
+            return question_id
+    # most of the category has been played, filter it once
+    unseen_ids = [question_id for question_id in ids
+                  if question_id not in previous_ids]
+    if not unseen_ids:
+        return None
+    return random.choice(unseen_ids)
+
+
+'''
+sample_unseen_ids(ids, previous_ids, count)
+    returns up to `count` distinct random ids of `ids` that are not in the
+    `previous_ids` set, fewer only when there are not enough unseen ones.
+    a sample of count + len(previous_ids) ids always holds `count` unseen
+    ones, so it's drawn once and filtered instead of the whole category.
+'''
+def sample_unseen_ids(ids, previous_ids, count):
+    sample = random.sample(ids, min(count + len(previous_ids), len(ids)))
+    return [question_id for question_id in sample
+            if question_id not in previous_ids][:count]
+
+
+'''
+build_buckets(rows)
+    returns the ids of the (id, difficulty) rows and their ids by
+    difficulty
+'''
+def build_buckets(rows):
+    ids = []
+    buckets = {}
+    for question_id, difficulty in rows:
+        ids.append(question_id)
+        buckets.setdefault(difficulty, []).append(question_id)
+    return ids, buckets
+
+
+'''
+target_difficulty(difficulties, streak, step)
+    the difficulty of the next question of an adaptive quiz: the easiest
+    one for a new streak, one level harder every `step` right answers. the
+    questions without a difficulty are not a level
+'''
+def target_difficulty(difficulties, streak, step=QUIZ_STREAK_STEP):
+    levels = sorted(level for level in difficulties if level is not None)
+    if not levels:
+        return None
+    return levels[min(streak // max(step, 1), len(levels) - 1)]
+
+
+'''
+draw_by_difficulty(buckets, difficulty, previous_ids)
+    draws an unseen id of the `difficulty` bucket, or of the closest
+    difficulty when all of its questions have been played, then of the
+    questions without a difficulty
+'''
+def draw_by_difficulty(buckets, difficulty, previous_ids):
+    levels = sorted((level for level in buckets if level is not None),
+                    key=lambda level: (abs(level - difficulty), level))
+    if None in buckets:
+        levels.append(None)
+    for level in levels:
+        question_id = draw_unseen_id(buckets[level], previous_ids)
+        if question_id is not None:
+            return question_id
+    return None
+
+
+'''
+QuestionSelector
+    keeps the question ids of every category in memory (category 0 is all
+    the questions), also split by difficulty, and draws a random unseen id
+    with set-based exclusion. only the drawn question is loaded from the
+    database, as a row of serialization.question_rows().
+
+    the ids of a category are dropped when a question is inserted or
+    deleted by this app, and reloaded after QUIZ_IDS_TTL seconds to pick
+    up the writes of the other workers. with a `catalog` the ids and the
+    questions are read from it instead of the database.
+'''
+class QuestionSelector:
+
+    def __init__(self, app, catalog=None):
+        self.catalog = catalog
+        self.ttl = app.config.get('QUIZ_IDS_TTL', 60)
+        self.streak_step = app.config.get('QUIZ_STREAK_STEP',
+                                          QUIZ_STREAK_STEP)
+        self.ids = {}
+        self.lock = threading.Lock()
+        app.extensions['question_selector'] = self
+        add_question_listener(app, self.question_changed)
+
+    def question_changed(self, action, question):
+        self.invalidate()
+
+    def invalidate(self, category=None):
+        with self.lock:
+            if category is None:
+                self.ids.clear()
+            else:
+                self.ids.pop(0, None)
+                self.ids.pop(category, None)
+
+    def load_ids(self, category):
+        # (ids, ids by difficulty) of the category in one query
+        query = db.session.query(Question.id, Question.difficulty)
+        if category != 0:
+            query = query.filter(Question.category == category)
+        # in id order, like the catalog, for the positions of the sessions
+        return build_buckets(query.order_by(Question.id))
+
+    def load(self, category):
+        if self.catalog is not None:
+            return self.catalog.category_buckets(category)
+        with self.lock:
+            cached = self.ids.get(category)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        loaded = self.load_ids(category)
+        with self.lock:
+            self.ids[category] = (time.monotonic(), loaded)
+        return loaded
+
+    def category_ids(self, category):
+        return self.load(category)[0]
+
+    def difficulty_buckets(self, category):
+        return self.load(category)[1]
+
+    def target_difficulty(self, category, streak):
+        return target_difficulty(self.difficulty_buckets(category), streak,
+                                 self.streak_step)
+
+    def pick(self, category, previous_ids, difficulty=None, retry=True):
+        # returns a random question of the category that is not in
+        # previous_ids, or None when all of them have been played. with a
+        # difficulty it's drawn from that bucket first.
+        if difficulty is None:
+            question_id = draw_unseen_id(self.category_ids(category),
+                                         previous_ids)
+        else:
+            question_id = draw_by_difficulty(
+                self.difficulty_buckets(category), difficulty, previous_ids)
+        if question_id is None:
+            return None
+        if self.catalog is not None:
+            question = self.catalog.question(question_id)
+        else:
+            question = load_question_row(question_id)
+        if question is None and retry:
+            # deleted by another worker, reload the ids and draw again
+            self.invalidate(category)
+            return self.pick(category, previous_ids, difficulty,
+                             retry=False)
+        return question
+
+    def pick_many(self, category, previous_ids, count, retry=True):
+        # returns up to `count` random questions of the category that are
+        # not in previous_ids, loaded together
+        question_ids = sample_unseen_ids(self.category_ids(category),
+                                         previous_ids, count)
+        if self.catalog is not None:
+            questions = [self.catalog.question(question_id)
+                         for question_id in question_ids]
+        else:
+            rows = {row[0]: row for row in load_question_rows(question_ids)}
+            questions = [rows.get(question_id)
+                         for question_id in question_ids]
+        if None in questions and retry:
+            # some were deleted by another worker, draw again
+            self.invalidate(category)
+            return self.pick_many(category, previous_ids, count,
+                                  retry=False)
+        return [question for question in questions if question is not None]
@@ -0,0 +1,203 @@
+import secrets
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+HASH_MASK = (1 << 64) - 1
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+FEISTEL_ROUNDS = 4
+
+
+def mix(value):
+    # the splitmix64 finalizer, every input bit flips half of the output
+    value = ((value ^ value >> 30) * 0xBF58476D1CE4E5B9) & HASH_MASK
+    value = ((value ^ value >> 27) * 0x94D049BB133111EB) & HASH_MASK
+    return value ^ value >> 31
+
+
+'''
+permuted_index(seed, size, index)
+    the position at `index` of a random permutation of range(size) picked
+    by `seed`, without building it: a Feistel network is a bijection of
+    the smallest power of 4 over `size`, and the values past `size` are
+    walked through again (at most 4 steps on average). memory is O(1) at
+    any size, a quiz only keeps its seed and how far it went.
+'''
+def permuted_index(seed, size, index):
+    half = max((size - 1).bit_length() + 1, 2) // 2
+    mask = (1 << half) - 1
+    keys = [mix(seed + round_number * HASH_MULTIPLIER)
+            for round_number in range(FEISTEL_ROUNDS)]
+    while True:
+        left, right = index >> half, index & mask
+        for key in keys:
+            left, right = right, left ^ (mix(right ^ key) & mask)
+        index = (left << half) | right
+        if index < size:
+            return index
+
+
+'''
+id_range(ids)
+    the (first id, span) of the sorted ids of a category, the order of a
+    quiz is a permutation of that range of ids fixed when it starts, so
+    it never moves with the questions inserted or deleted meanwhile
+'''
+def id_range(ids):
+    if not ids:
+        return 0, 0
+    return ids[0], ids[-1] - ids[0] + 1
+
+
+'''
+next_in_range(seed, first, span, cursor, ids)
+    the first cursor from `cursor` on whose permuted id is still one of
+    `ids` (the sorted ids of the category now) and that id, or (span,
+    None) once the range is played. every id of the range comes once, the
+    deleted ones and the gaps of the range are skipped: a sparse category
+    walks (span / len(ids)) positions per question on average.
+'''
+def next_in_range(seed, first, span, cursor, ids):
+    while cursor < span:
+        question_id = first + permuted_index(seed, span, cursor)
+        index = bisect_left(ids, question_id)
+        if index < len(ids) and ids[index] == question_id:
+            return cursor, question_id
+        cursor += 1
+    return cursor, None
+
+
+'''
+MemorySessionStore
+    keeps the (category, seed, first id, span, cursor) of every quiz
+    session in process, a fixed size entry whatever the category size, so
+    the memory is bounded by `max_sessions`. sessions expire `ttl` seconds
+    after their last use and the least recently used ones are evicted past
+    `max_sessions`.
+'''
+class MemorySessionStore:
+
+    def __init__(self, max_sessions=10000, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, token, category, seed, first, span):
+        with self.lock:
+            self.sessions[token] = (time.monotonic() + self.ttl,
+                                    category, seed, first, span, 0)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def advance(self, token, count=1):
+        # returns the (category, seed, first, span, cursor) of the session
+        # and moves its cursor `count` positions on, raises KeyError for
+        # an unknown or expired session
+        with self.lock:
+            (expires_at, category, seed, first, span,
+             cursor) = self.sessions[token]
+            if expires_at < time.monotonic():
+                del self.sessions[token]
+                raise KeyError(token)
+            self.sessions[token] = (time.monotonic() + self.ttl, category,
+                                    seed, first, span, cursor + count)
+            self.sessions.move_to_end(token)
+            return category, seed, first, span, cursor
+
+
+'''
+RedisSessionStore
+    keeps the sessions in a redis compatible server so every worker can
+    serve them, a session is a hash whose cursor is moved with HINCRBY in
+    a MULTI transaction. `client` only needs hset, delete and pipeline.
+'''
+class RedisSessionStore:
+
+    def __init__(self, client, ttl=3600, prefix='trivia:quiz:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def create(self, token, category, seed, first, span):
+        key = self.prefix + token
+        pipeline = self.client.pipeline()
+        pipeline.hset(key, mapping={'category': category, 'seed': seed,
+                                    'first': first, 'span': span,
+                                    'cursor': 0})
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+
+    def advance(self, token, count=1):
+        key = self.prefix + token
+        pipeline = self.client.pipeline()
+        pipeline.exists(key)
+        pipeline.hincrby(key, 'cursor', count)
+        pipeline.expire(key, self.ttl)
+        pipeline.hmget(key, 'category', 'seed', 'first', 'span')
+        exists, cursor, _, fields = pipeline.execute()
+        if not exists:
+            # HINCRBY made a hash of the expired session
+            self.client.delete(key)
+            raise KeyError(token)
+        category, seed, first, span = (int(field) for field in fields)
+        return category, seed, first, span, cursor - count
+
+
+'''
+create_session_store(app)
+    builds the store named by QUIZ_SESSION_STORE, 'memory' (the default)
+    or 'redis' with QUIZ_SESSION_REDIS_URL, a store instance can also be
+    given directly in the config
+'''
+def create_session_store(app):
+    store = app.config.get('QUIZ_SESSION_STORE', 'memory')
+    ttl = app.config.get('QUIZ_SESSION_TTL', 3600)
+    if store == 'memory':
+        return MemorySessionStore(
+            app.config.get('QUIZ_SESSION_MAX', 10000), ttl)
+    if store == 'redis':
+        import redis
+        client = redis.Redis.from_url(
+            app.config.get('QUIZ_SESSION_REDIS_URL', 'redis://localhost'))
+        return RedisSessionStore(client, ttl)
+    return store
+
+
+'''
+QuizSessions
+    a quiz session is a random order of the range of the category ids when
+    it starts, a seed of permuted_index() picked once, every round then
+    moves the cursor of the store past the next id still in the category.
+    a question is never asked twice, the ones deleted during the session
+    are skipped and the ones inserted are not asked.
+'''
+class QuizSessions:
+
+    def __init__(self, app, selector):
+        self.selector = selector
+        self.store = create_session_store(app)
+        app.extensions['quiz_sessions'] = self
+
+    def start(self, category):
+        # returns the session token and the number of questions
+        question_ids = self.selector.category_ids(category)
+        token = secrets.token_urlsafe(16)
+        self.store.create(token, category, secrets.randbits(63),
+                          *id_range(question_ids))
+        return token, len(question_ids)
+
+    def next_id(self, token):
+        # the next question id, None when the quiz is finished and
+        # KeyError for an unknown or expired session
+        category, seed, first, span, cursor = self.store.advance(token)
+        position, question_id = next_in_range(
+            seed, first, span, cursor, self.selector.category_ids(category))
+        if position > cursor:
+            # the skipped positions, read again by no other round
+            self.store.advance(token, position - cursor)
+        return question_id
@@ -0,0 +1,379 @@
+import atexit
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import has_app_context
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db, Question, QuizResult, LeaderboardEntry
+from .metrics import render_counter
+
+RESULTS_BATCH_SIZE = 500
+# seconds an answer waits at most before it's written
+RESULTS_FLUSH_INTERVAL = 1.0
+# answers kept in memory while the database is unavailable, the newest
+# ones are dropped past it
+RESULTS_QUEUE_MAX = 100000
+PLAYER_MAX_LENGTH = 50
+LEADERBOARD_SIZE = 10
+LEADERBOARD_MAX_SIZE = 100
+# seconds a served question can be answered for the leaderboard
+RESULTS_TOKEN_TTL = 3600
+
+logger = logging.getLogger(__name__)
+
+
+'''
+parse_results(results)
+    the (player, question id, answer, result token) of the `results` of a
+    quiz request, raises ValueError for a malformed one
+'''
+def parse_results(results):
+    if not isinstance(results, list):
+        raise ValueError('results must be a list')
+    parsed = []
+    for result in results:
+        if not isinstance(result, dict):
+            raise ValueError('a result must be an object')
+        player = result.get('player')
+        question_id = result.get('question_id')
+        answer = result.get('answer')
+        token = result.get('token')
+        if (not isinstance(player, str) or not player.strip() or
+                len(player.strip()) > PLAYER_MAX_LENGTH or
+                not isinstance(question_id, int) or
+                not isinstance(answer, str) or
+                not isinstance(token, str)):
+            raise ValueError('invalid result')
+        parsed.append((player.strip(), question_id, answer, token))
+    return parsed
+
+
+def is_correct(answer, expected):
+    return answer.strip().casefold() == expected.strip().casefold()
+
+
+'''
+aggregate_results(events)
+    the (answers, right answers) of every (category, player) of the
+    queued events, the quizzes of a category also count in category 0
+    unless they already are category 0
+'''
+def aggregate_results(events):
+    totals = {}
+    for player, category, _, correct, *_ in events:
+        for key in {(category, player), (0, player)}:
+            answers, right = totals.get(key, (0, 0))
+            totals[key] = (answers + 1, right + int(correct))
+    return totals
+
+
+'''
+insert_results(events)
+    inserts the queued answers, an answer of a served question already
+    written (its result token sent again, to any worker) is skipped by
+    the unique index of (question_id, served). returns the inserted ones.
+'''
+def insert_results(events):
+    table = QuizResult.__table__
+    fresh = []
+    served = set()
+    for event in events:
+        if event[6] is not None:
+            if (event[2], event[6]) in served:
+                continue
+            served.add((event[2], event[6]))
+        fresh.append(event)
+    rows = [{'player': player, 'category': category,
+             'question_id': question_id, 'correct': correct,
+             'answered_at': answered_at, 'served': served_id}
+            for player, category, question_id, correct, answered_at, _,
+            served_id in fresh]
+    if not rows:
+        return []
+    if db.engine.dialect.name == 'postgresql':
+        # one statement, atomic against the flushes of the other workers
+        inserted = {tuple(row) for row in db.session.execute(
+            pg_insert(table).values(rows).on_conflict_do_nothing(
+                index_elements=[table.c.question_id, table.c.served]
+            ).returning(table.c.question_id, table.c.served))}
+    else:
+        written = set(db.session.query(
+            QuizResult.question_id, QuizResult.served).filter(
+            QuizResult.served.in_([served_id for _, served_id in served])))
+        rows = [row for row in rows
+                if (row['question_id'], row['served']) not in written]
+        if rows:
+            db.session.execute(table.insert(), rows)
+        inserted = {(row['question_id'], row['served']) for row in rows}
+    return [event for event in fresh
+            if event[6] is None or (event[2], event[6]) in inserted]
+
+
+def add_to_leaderboard(totals):
+    table = LeaderboardEntry.__table__
+    rows = [{'category': category, 'player': player, 'answers': answers,
+             'correct': correct}
+            for (category, player), (answers, correct)
+            in sorted(totals.items())]
+    if db.engine.dialect.name == 'postgresql':
+        # one statement, atomic against the flushes of the other workers
+        statement = pg_insert(table)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.category, table.c.player],
+            set_={'answers': table.c.answers + statement.excluded.answers,
+                  'correct': table.c.correct + statement.excluded.correct}
+        ), rows)
+        return
+    for row in rows:
+        updated = db.session.execute(table.update().where(
+            (table.c.category == row['category']) &
+            (table.c.player == row['player'])
+        ).values(answers=table.c.answers + row['answers'],
+                 correct=table.c.correct + row['correct']))
+        if updated.rowcount == 0:
+            db.session.execute(table.insert(), [row])
+
+
+'''
+load_leaderboard(category, limit)
+    the players with the most right answers in the category, 0 is every
+    quiz. reads the aggregates only, never the results.
+'''
+def load_leaderboard(category=0, limit=LEADERBOARD_SIZE):
+    return [{'player': player, 'correct': correct, 'answers': answers}
+            for player, correct, answers in
+            db.session.query(LeaderboardEntry.player,
+                             LeaderboardEntry.correct,
+                             LeaderboardEntry.answers)
+            .filter(LeaderboardEntry.category == category)
+            .order_by(LeaderboardEntry.correct.desc(),
+                      LeaderboardEntry.answers, LeaderboardEntry.player)
+            .limit(limit)]
+
+
+'''
+QuizResults
+    records the answers of the quizzes without a write in the request: they
+    are queued in memory and written by a background thread every
+    RESULTS_FLUSH_INTERVAL seconds, or as soon as RESULTS_BATCH_SIZE are
+    queued, with the leaderboard updated in the same transaction. the
+    answers still queued when a worker dies are lost, a failed flush is
+    retried with the next one.
+    QUIZ_RESULTS_FLUSH_INTERVAL set to None starts no thread, flush() is
+    then called by the owner of the app (the tests).
+
+    the players never send their score: every served question comes with
+    a result token signed with SECRET_KEY, and a result is the answer to a
+    question of `previous_questions` with its token. the server checks the
+    answer, an unsigned, expired or replayed token is dropped. without
+    SECRET_KEY a random key is made by create_app, shared by the workers
+    forked by gunicorn --preload.
+'''
+class QuizResults:
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = app.config.get('QUIZ_RESULTS', True)
+        self.secret = (app.config.get('SECRET_KEY') or
+                       os.environ.get('SECRET_KEY') or
+                       secrets.token_hex(32))
+        if isinstance(self.secret, str):
+            self.secret = self.secret.encode()
+        self.token_ttl = app.config.get('QUIZ_RESULTS_TOKEN_TTL',
+                                        RESULTS_TOKEN_TTL)
+        self.batch_size = app.config.get('QUIZ_RESULTS_BATCH_SIZE',
+                                         RESULTS_BATCH_SIZE)
+        self.flush_interval = app.config.get('QUIZ_RESULTS_FLUSH_INTERVAL',
+                                             RESULTS_FLUSH_INTERVAL)
+        self.queue_max = app.config.get('QUIZ_RESULTS_QUEUE_MAX',
+                                        RESULTS_QUEUE_MAX)
+        self.queue = []
+        self.flushed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failures = 0
+        self.flush_lag = 0.0
+        self.flush_seconds = 0.0
+        self.writer_pid = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        app.extensions['quiz_results'] = self
+
+    def sign(self, question_id, issued, nonce):
+        message = '{}.{}.{}'.format(question_id, issued, nonce).encode()
+        return hmac.new(self.secret, message,
+                        hashlib.sha256).hexdigest()[:32]
+
+    def issue(self, question_id):
+        # the result token of a question served now
+        issued = int(time.time())
+        nonce = secrets.token_hex(8)
+        return '{}.{}.{}'.format(issued, nonce,
+                                 self.sign(question_id, issued, nonce))
+
+    def served(self, question_id, token):
+        # the nonce of a valid token of the question, or None
+        try:
+            issued, nonce, signature = token.split('.')
+            issued = int(issued)
+        except ValueError:
+            return None
+        if (not 0 <= time.time() - issued <= self.token_ttl or
+                not hmac.compare_digest(
+                    self.sign(question_id, issued, nonce), signature)):
+            return None
+        return nonce
+
+    def verify(self, results, previous_ids):
+        # the (player, question id, correct, nonce) of the parsed results
+        # that answer a question served in this quiz, checked against the
+        # answers of the questions table
+        if not self.enabled or not results:
+            return []
+        checked = [(player, question_id, answer,
+                    self.served(question_id, token))
+                   for player, question_id, answer, token in results
+                   if question_id in previous_ids]
+        checked = [result for result in checked if result[3] is not None]
+        answers = dict(db.session.query(Question.id, Question.answer).filter(
+            Question.id.in_({result[1] for result in checked})))
+        verified = [(player, question_id,
+                     is_correct(answer, answers[question_id]), nonce)
+                    for player, question_id, answer, nonce in checked
+                    if question_id in answers]
+        with self.lock:
+            self.rejected += len(results) - len(verified)
+        return verified
+
+    def record(self, category, results):
+        # queues the (player, question id, correct, nonce) results of a
+        # quiz of the category, the nonce of the result token or None
+        if not self.enabled or not results:
+            return
+        self.start_writer()
+        answered_at = datetime.datetime.utcnow()
+        queued_at = time.monotonic()
+        with self.lock:
+            room = self.queue_max - len(self.queue)
+            if room < len(results):
+                self.dropped += len(results) - max(room, 0)
+                results = results[:max(room, 0)]
+            self.queue.extend((player, category, question_id, correct,
+                               answered_at, queued_at, served)
+                              for player, question_id, correct, served
+                              in results)
+            full = len(self.queue) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def depth(self):
+        return len(self.queue)
+
+    def oldest_age(self):
+        # seconds the oldest queued answer has been waiting
+        with self.lock:
+            queued_at = self.queue[0][5] if self.queue else None
+        return 0.0 if queued_at is None else time.monotonic() - queued_at
+
+    def start_writer(self):
+        # one thread per process, the workers forked after create_app
+        # start their own
+        if self.flush_interval is None or self.writer_pid == os.getpid():
+            return
+        with self.lock:
+            if self.writer_pid == os.getpid():
+                return
+            self.writer_pid = os.getpid()
+            threading.Thread(target=self.write_behind, daemon=True).start()
+            atexit.register(self.flush_all)
+
+    def write_behind(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                while self.flush() >= self.batch_size:
+                    pass
+            except Exception:
+                logger.exception('quiz results not written, retrying')
+
+    def flush_all(self):
+        while self.flush():
+            pass
+
+    def flush(self):
+        # writes up to RESULTS_BATCH_SIZE queued answers and their
+        # leaderboard totals in one transaction, returns how many
+        with self.flush_lock:
+            with self.lock:
+                events = self.queue[:self.batch_size]
+                del self.queue[:self.batch_size]
+            if not events:
+                return 0
+            start = time.perf_counter()
+            # the thread pushes an app context, the tests flush in theirs
+            context = (nullcontext() if has_app_context()
+                       else self.app.app_context())
+            try:
+                with context:
+                    try:
+                        inserted = insert_results(events)
+                        if inserted:
+                            add_to_leaderboard(aggregate_results(inserted))
+                        db.session.commit()
+                    except Exception:
+                        db.session.rollback()
+                        raise
+            except Exception:
+                self.failures += 1
+                with self.lock:
+                    # back in front, in their order, for the next flush
+                    kept = events[:max(self.queue_max - len(self.queue), 0)]
+                    self.queue[:0] = kept
+                    self.dropped += len(events) - len(kept)
+                raise
+            self.flushed += len(inserted)
+            with self.lock:
+                # their result token was already written
+                self.rejected += len(events) - len(inserted)
+            self.flush_lag = time.monotonic() - events[0][5]
+            self.flush_seconds = time.perf_counter() - start
+            return len(events)
+
+    def render(self):
+        lines = []
+        lines += render_counter('trivia_quiz_results_queue_depth',
+                                'Quiz answers waiting to be written.',
+                                self.depth(), 'gauge')
+        lines += render_counter('trivia_quiz_results_oldest_seconds',
+                                'Age of the oldest quiz answer waiting to '
+                                'be written.', self.oldest_age(), 'gauge')
+        lines += render_counter('trivia_quiz_results_flush_lag_seconds',
+                                'Wait of the oldest answer of the last '
+                                'flush.', self.flush_lag, 'gauge')
+        lines += render_counter('trivia_quiz_results_flush_seconds',
+                                'Duration of the last flush.',
+                                self.flush_seconds, 'gauge')
+        lines += render_counter('trivia_quiz_results_flushed_total',
+                                'Quiz answers written.', self.flushed)
+        lines += render_counter('trivia_quiz_results_dropped_total',
+                                'Quiz answers dropped for a full queue.',
+                                self.dropped)
+        lines += render_counter('trivia_quiz_results_rejected_total',
+                                'Quiz answers dropped for a token that is '
+                                'invalid, expired, sent again or of a '
+                                'question not served in the quiz.',
+                                self.rejected)
+        lines += render_counter('trivia_quiz_results_flush_failures_total',
+                                'Flushes that failed and were retried.',
+                                self.failures)
+        return '\n'.join(lines) + '\n'
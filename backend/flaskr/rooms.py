@@ -0,0 +1,736 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+
+from .metrics import render_counter
+from .quiz_sessions import id_range, next_in_range
+from .serialization import load_question_row
+
+# events kept for a client that reads slower than the rounds go, past
+# them it's disconnected and its EventSource reconnects
+ROOM_QUEUE_SIZE = 100
+# seconds between the comments that keep an idle stream open
+ROOM_HEARTBEAT = 15.0
+ROOM_TTL = 3600
+ROOM_SCOREBOARD_SIZE = 10
+ROOM_PLAYER_MAX_LENGTH = 50
+
+logger = logging.getLogger(__name__)
+
+
+'''
+room_id(host_key)
+    the public id of the room of a host key, so a worker checks the host
+    of a request without reading the room.
+'''
+def room_id(host_key):
+    return hashlib.sha256(host_key.encode()).hexdigest()[:16]
+
+
+def is_host(room, host_key):
+    return (isinstance(host_key, str) and
+            hmac.compare_digest(room_id(host_key), room))
+
+
+'''
+format_event(event, data, event_id)
+    the bytes of a Server-Sent Event, encoded once and written to every
+    client of the room
+'''
+def format_event(event, data, event_id=None):
+    lines = [] if event_id is None else ['id: {}'.format(event_id)]
+    lines.append('event: ' + event)
+    lines.append('data: ' + json.dumps(data))
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def is_correct(answer, expected):
+    return (isinstance(answer, str) and
+            answer.strip().casefold() == expected.strip().casefold())
+
+
+def rank_scores(scores):
+    ranked = sorted(scores, key=lambda item: (-item[1], item[0]))
+    return [{'player': player, 'score': score}
+            for player, score in ranked[:ROOM_SCOREBOARD_SIZE]]
+
+
+'''
+round_results(round_number, question, answers, scoreboard)
+    the data of the `results` event of a round, `answers` is the
+    correctness of the answer of every player
+'''
+def round_results(round_number, question, answers, scoreboard):
+    return {
+        'round': round_number,
+        'question_id': question[0],
+        'answer': question[2],
+        'answers': len(answers),
+        'correct': sum(1 for correct in answers if correct),
+        'scoreboard': scoreboard
+    }
+
+
+'''
+MemoryRoomStore
+    the rooms of a single process, for one worker or the tests. a room is
+    the order of its questions (the seed and the cursor of a quiz
+    session), the question of the open round, the answers to it and the
+    scores. rooms expire `ttl` seconds after their last write.
+'''
+class MemoryRoomStore:
+
+    def __init__(self, ttl=ROOM_TTL):
+        self.ttl = ttl
+        self.rooms = {}
+        self.pruned_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def prune(self):
+        now = time.monotonic()
+        if now - self.pruned_at < 60:
+            return
+        self.pruned_at = now
+        for room, state in list(self.rooms.items()):
+            if state['expires_at'] < now:
+                del self.rooms[room]
+
+    def room(self, room):
+        state = self.rooms.get(room)
+        if state is None or state['expires_at'] < time.monotonic():
+            raise KeyError(room)
+        state['expires_at'] = time.monotonic() + self.ttl
+        return state
+
+    def create(self, room, category, seed, size, first, span):
+        with self.lock:
+            self.prune()
+            self.rooms[room] = {
+                'category': category, 'seed': seed, 'size': size,
+                'first': first, 'span': span, 'cursor': 0, 'round': 0,
+                'question': None, 'answers': {}, 'scores': {},
+                'expires_at': time.monotonic() + self.ttl}
+
+    def get(self, room):
+        # (round, size, question) of the room, or None
+        with self.lock:
+            state = self.rooms.get(room)
+            if state is None or state['expires_at'] < time.monotonic():
+                return None
+            return state['round'], state['size'], state['question']
+
+    def advance(self, room, count=1):
+        with self.lock:
+            state = self.room(room)
+            state['cursor'] += count
+            return (state['category'], state['seed'], state['size'],
+                    state['first'], state['span'], state['cursor'] - count)
+
+    def start_round(self, room, question):
+        # the number of the new round and the results of the previous one
+        with self.lock:
+            state = self.room(room)
+            results = None
+            if state['question'] is not None:
+                results = round_results(
+                    state['round'], state['question'],
+                    list(state['answers'].values()),
+                    rank_scores(state['scores'].items()))
+            state['round'] += 1
+            state['question'] = question
+            state['answers'] = {}
+            return state['round'], results
+
+    def answer(self, room, player, question_id, answer):
+        # (correct, first answer of the player, category), None when the
+        # question is not the one of the open round
+        with self.lock:
+            state = self.room(room)
+            question = state['question']
+            if question is None or question[0] != question_id:
+                return None
+            correct = is_correct(answer, question[2])
+            if player in state['answers']:
+                return correct, False, state['category']
+            state['answers'][player] = correct
+            state['scores'][player] = (state['scores'].get(player, 0) +
+                                       int(correct))
+            return correct, True, state['category']
+
+    def close(self, room):
+        # the rounds played, the results of the last one and the final
+        # scoreboard, the room is deleted
+        with self.lock:
+            state = self.room(room)
+            del self.rooms[room]
+        results = None
+        if state['question'] is not None:
+            results = round_results(state['round'], state['question'],
+                                    list(state['answers'].values()),
+                                    rank_scores(state['scores'].items()))
+        return state['round'], results, rank_scores(state['scores'].items())
+
+
+'''
+RedisRoomStore
+    the rooms in a redis compatible server, read and written by every
+    worker. a room is a hash, with a hash of the answers of each round and
+    a sorted set of the scores, all expiring `ttl` seconds after the last
+    write. a round is started and an answer checked in a WATCH/MULTI
+    transaction, so two workers never both take a player's first answer or
+    the same round number. `client` only needs pipeline, zincrby, expire
+    and delete.
+'''
+class RedisRoomStore:
+
+    def __init__(self, client, ttl=ROOM_TTL, prefix='trivia:room:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def keys(self, room, round_number=None):
+        key = self.prefix + room
+        answers_key = '{}:answers:{}'.format(key, round_number)
+        return key, answers_key, key + ':scores'
+
+    def transaction(self, call, *watched):
+        # runs call(pipeline) until none of the watched keys changed
+        # before its MULTI
+        import redis
+        with self.client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(*watched)
+                    return call(pipeline)
+                except redis.WatchError:
+                    continue
+
+    def read_scores(self, client, room):
+        _, _, scores_key = self.keys(room)
+        scores = client.zrevrange(scores_key, 0, ROOM_SCOREBOARD_SIZE - 1,
+                                  withscores=True)
+        return rank_scores((player.decode(), int(score))
+                           for player, score in scores)
+
+    def read_results(self, client, room, round_number, question):
+        if question is None:
+            return None
+        _, answers_key, _ = self.keys(room, round_number)
+        answers = client.hvals(answers_key)
+        return round_results(round_number, question,
+                             [answer == b'1' for answer in answers],
+                             self.read_scores(client, room))
+
+    def read(self, client, room):
+        key, _, _ = self.keys(room)
+        category, seed, size, round_number, question = client.hmget(
+            key, 'category', 'seed', 'size', 'round', 'question')
+        if category is None:
+            raise KeyError(room)
+        return (int(category), int(seed), int(size), int(round_number),
+                None if question is None else json.loads(question))
+
+    def create(self, room, category, seed, size, first, span):
+        key, _, _ = self.keys(room)
+        pipeline = self.client.pipeline()
+        pipeline.hset(key, mapping={'category': category, 'seed': seed,
+                                    'size': size, 'first': first,
+                                    'span': span, 'cursor': 0, 'round': 0})
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+
+    def get(self, room):
+        try:
+            _, _, size, round_number, question = self.read(self.client,
+                                                           room)
+        except KeyError:
+            return None
+        return round_number, size, question
+
+    def advance(self, room, count=1):
+        key, _, scores_key = self.keys(room)
+        pipeline = self.client.pipeline()
+        pipeline.exists(key)
+        pipeline.hincrby(key, 'cursor', count)
+        pipeline.hmget(key, 'category', 'seed', 'size', 'first', 'span')
+        pipeline.expire(key, self.ttl)
+        pipeline.expire(scores_key, self.ttl)
+        exists, cursor, fields, _, _ = pipeline.execute()
+        if not exists:
+            # HINCRBY made a hash of the expired room
+            self.client.delete(key)
+            raise KeyError(room)
+        category, seed, size, first, span = (int(field) for field in fields)
+        return category, seed, size, first, span, cursor - count
+
+    def start_round(self, room, question):
+        key, _, _ = self.keys(room)
+
+        def start(pipeline):
+            _, _, _, round_number, previous = self.read(pipeline, room)
+            results = self.read_results(pipeline, room, round_number,
+                                        previous)
+            _, answers_key, _ = self.keys(room, round_number + 1)
+            pipeline.multi()
+            pipeline.hset(key, mapping={'round': round_number + 1,
+                                        'question': json.dumps(question)})
+            pipeline.expire(key, self.ttl)
+            pipeline.execute()
+            return round_number + 1, results
+        return self.transaction(start, key)
+
+    def answer(self, room, player, question_id, answer):
+        key, _, scores_key = self.keys(room)
+
+        def check(pipeline):
+            category, _, _, round_number, question = self.read(pipeline,
+                                                               room)
+            if question is None or question[0] != question_id:
+                return None
+            correct = is_correct(answer, question[2])
+            _, answers_key, _ = self.keys(room, round_number)
+            pipeline.multi()
+            pipeline.hsetnx(answers_key, player, int(correct))
+            pipeline.expire(answers_key, self.ttl)
+            first, _ = pipeline.execute()
+            return correct, bool(first), category
+        checked = self.transaction(check, key)
+        if checked is not None and checked[1]:
+            # only the first answer of the player got here
+            self.client.zincrby(scores_key, int(checked[0]), player)
+            self.client.expire(scores_key, self.ttl)
+        return checked
+
+    def close(self, room):
+        key, _, scores_key = self.keys(room)
+
+        def close(pipeline):
+            _, _, _, round_number, question = self.read(pipeline, room)
+            results = self.read_results(pipeline, room, round_number,
+                                        question)
+            scoreboard = self.read_scores(pipeline, room)
+            pipeline.multi()
+            pipeline.delete(key, scores_key,
+                            *[self.keys(room, number)[1]
+                              for number in range(1, round_number + 1)])
+            pipeline.execute()
+            return round_number, results, scoreboard
+        return self.transaction(close, key)
+
+
+'''
+MemoryPubSub
+    delivers the messages of a room to the handlers of this process only,
+    for a single worker or the tests
+'''
+class MemoryPubSub:
+
+    def __init__(self):
+        self.handlers = []
+
+    def start(self):
+        pass
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def publish(self, room, message):
+        for handler in list(self.handlers):
+            handler(room, message)
+
+
+'''
+RedisPubSub
+    delivers the messages of a room to every worker through a redis
+    compatible server. each process has one connection subscribed to the
+    channels of all the rooms, started by the post_fork hook of
+    gunicorn.conf.py (or on first use) so the workers forked by gunicorn
+    --preload open their own. `client` only needs publish and pubsub.
+'''
+class RedisPubSub:
+
+    def __init__(self, client, prefix='trivia:room:'):
+        self.client = client
+        self.prefix = prefix
+        self.handlers = []
+        self.listener_pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid == os.getpid():
+                return
+            # subscribed before returning, the messages published next
+            # are not missed
+            subscription = self.subscribe_all()
+            self.listener_pid = os.getpid()
+            threading.Thread(target=self.listen, args=(subscription,),
+                             daemon=True).start()
+
+    def subscribe_all(self):
+        subscription = self.client.pubsub(ignore_subscribe_messages=True)
+        subscription.psubscribe(self.prefix + '*')
+        return subscription
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def publish(self, room, message):
+        self.client.publish(self.prefix + room, json.dumps(message))
+
+    def listen(self, subscription):
+        while True:
+            try:
+                for message in subscription.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    channel = message['channel']
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    room = channel[len(self.prefix):]
+                    for handler in list(self.handlers):
+                        handler(room, json.loads(message['data']))
+            except Exception:
+                logger.exception('room listener failed, reconnecting')
+                try:
+                    subscription.close()
+                except Exception:
+                    pass
+                time.sleep(1)
+                try:
+                    subscription = self.subscribe_all()
+                except Exception:
+                    pass
+
+
+'''
+create_room_backends(app)
+    the (pub/sub, store) of the rooms named by ROOM_PUBSUB, from the app
+    config or the environment: 'memory' (the default) for a single
+    worker, 'redis' with ROOM_REDIS_URL for any number of workers, or
+    'off' to serve no rooms. a (pub/sub, store) pair can also be given
+    directly in the config.
+'''
+def create_room_backends(app):
+    backend = app.config.get('ROOM_PUBSUB',
+                             os.environ.get('ROOM_PUBSUB', 'memory'))
+    ttl = app.config.get('ROOM_TTL', ROOM_TTL)
+    if backend in ('memory', 'off'):
+        return MemoryPubSub(), MemoryRoomStore(ttl)
+    if backend == 'redis':
+        import redis
+        client = redis.Redis.from_url(app.config.get(
+            'ROOM_REDIS_URL',
+            os.environ.get('ROOM_REDIS_URL', 'redis://localhost')))
+        return RedisPubSub(client), RedisRoomStore(client, ttl)
+    return backend
+
+
+'''
+Listener
+    the queue of the events of one client, with the last round it was
+    sent so a round read from the store and then received from the
+    pub/sub is sent once
+'''
+class Listener(queue.Queue):
+
+    round = 0
+
+
+'''
+Broadcaster
+    the clients of the rooms streamed by this process. every message of
+    the pub/sub backend carries the data of its events, they are encoded
+    once and put on the queue of every client of the room: a round costs
+    the same whatever the number of players. the messages of rooms
+    without a client here are ignored, the state of the rooms is in the
+    store, and a client joining a room is sent its open question from it.
+'''
+class Broadcaster:
+
+    def __init__(self, pubsub, store, queue_size=ROOM_QUEUE_SIZE):
+        self.pubsub = pubsub
+        self.store = store
+        self.queue_size = queue_size
+        self.listeners = {}
+        # (round, event) of the open question of the rooms streamed here
+        self.current = {}
+        self.events = 0
+        self.deliveries = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        pubsub.subscribe(self.receive)
+
+    def publish(self, room, message):
+        self.pubsub.publish(room, message)
+
+    def receive(self, room, message):
+        with self.lock:
+            if room not in self.listeners:
+                return
+            chunks = []
+            if message.get('results') is not None:
+                chunks.append(format_event('results', message['results'],
+                                           message['results']['round']))
+            if message['type'] == 'round':
+                chunk = question_event(message['round'],
+                                       message['total_questions'],
+                                       message['question'])
+                chunks.append(chunk)
+                self.current[room] = (message['round'], chunk)
+                self.deliver(room, chunks, message['round'])
+                return
+            chunks.append(format_event('end', {
+                'rounds': message['rounds'],
+                'scoreboard': message['scoreboard']
+            }))
+            self.deliver(room, chunks)
+            self.close(room)
+
+    def deliver(self, room, chunks, round_number=None):
+        self.events += len(chunks)
+        for listener in list(self.listeners.get(room, ())):
+            if round_number is not None and listener.round >= round_number:
+                # sent from the store when it joined
+                continue
+            try:
+                for chunk in chunks:
+                    listener.put_nowait(chunk)
+                    self.deliveries += 1
+            except queue.Full:
+                self.dropped += 1
+                self.disconnect(room, listener)
+                continue
+            if round_number is not None:
+                listener.round = round_number
+
+    def remove(self, room, listener):
+        listeners = self.listeners.get(room)
+        if listeners is None or listener not in listeners:
+            return
+        listeners.discard(listener)
+        if not listeners:
+            del self.listeners[room]
+            self.current.pop(room, None)
+
+    def disconnect(self, room, listener):
+        # the stream ends at the None, after the queued events unless
+        # there's no room left for it
+        self.remove(room, listener)
+        while True:
+            try:
+                listener.put_nowait(None)
+                return
+            except queue.Full:
+                listener.get_nowait()
+
+    def close(self, room):
+        for listener in list(self.listeners.get(room, ())):
+            self.disconnect(room, listener)
+
+    def listen(self, room):
+        # the queue of a new client, starting with the open question.
+        # raises KeyError for an unknown room
+        self.pubsub.start()
+        listener = Listener(self.queue_size)
+        with self.lock:
+            # registered before the store is read, a round started in
+            # between is received
+            self.listeners.setdefault(room, set()).add(listener)
+            current = self.current.get(room)
+            if current is not None:
+                listener.round = current[0]
+                listener.put_nowait(current[1])
+                return listener
+        try:
+            state = self.store.get(room)
+        except Exception:
+            self.unlisten(room, listener)
+            raise
+        if state is None:
+            self.unlisten(room, listener)
+            raise KeyError(room)
+        round_number, size, question = state
+        if question is None:
+            return listener
+        chunk = question_event(round_number, size, public_question(question))
+        with self.lock:
+            if listener.round < round_number:
+                listener.round = round_number
+                listener.put_nowait(chunk)
+            if (room in self.listeners and
+                    self.current.get(room, (0,))[0] < round_number):
+                self.current[room] = (round_number, chunk)
+        return listener
+
+    def unlisten(self, room, listener):
+        with self.lock:
+            self.remove(room, listener)
+
+    def render(self):
+        with self.lock:
+            rooms = len(self.listeners)
+            listeners = sum(len(room_listeners) for room_listeners
+                            in self.listeners.values())
+        lines = []
+        lines += render_counter('trivia_rooms',
+                                'Quiz rooms streamed by this process.',
+                                rooms, 'gauge')
+        lines += render_counter('trivia_room_listeners',
+                                'Clients streaming the events of a room.',
+                                listeners, 'gauge')
+        lines += render_counter('trivia_room_events_total',
+                                'Room events encoded.', self.events)
+        lines += render_counter('trivia_room_deliveries_total',
+                                'Room events written to a client queue.',
+                                self.deliveries)
+        lines += render_counter('trivia_room_dropped_listeners_total',
+                                'Clients disconnected for a full queue.',
+                                self.dropped)
+        return '\n'.join(lines) + '\n'
+
+
+def public_question(question):
+    # the question sent to the players, without its answer
+    return {'id': question[0], 'question': question[1],
+            'category': question[3], 'difficulty': question[4]}
+
+
+def question_event(round_number, total_questions, question):
+    return format_event('question', {
+        'round': round_number,
+        'total_questions': total_questions,
+        'question': question
+    }, round_number)
+
+
+'''
+QuizRooms
+    quiz rooms played by many players at once. the host opens a room of a
+    category and moves it round by round, every round draws one question
+    (one query whatever the number of players) and broadcasts it to the
+    players streaming GET /rooms/<room>/events. the store is the state of
+    the rooms for every worker: the round number and the first answer of
+    a player are taken atomically there, the answers are also recorded
+    with the quiz results.
+'''
+class QuizRooms:
+
+    def __init__(self, app, selector, results=None):
+        self.selector = selector
+        self.results = results
+        self.heartbeat = app.config.get('ROOM_HEARTBEAT', ROOM_HEARTBEAT)
+        self.enabled = app.config.get(
+            'ROOM_PUBSUB', os.environ.get('ROOM_PUBSUB')) != 'off'
+        self.pubsub, self.store = create_room_backends(app)
+        self.broadcaster = Broadcaster(
+            self.pubsub, self.store,
+            app.config.get('ROOM_QUEUE_SIZE', ROOM_QUEUE_SIZE))
+        app.extensions['rooms'] = self
+
+    @property
+    def shared(self):
+        # whether the rooms are served by every worker
+        return not isinstance(self.pubsub, MemoryPubSub)
+
+    def start(self):
+        # subscribes this process to the rooms, see gunicorn.conf.py
+        if self.enabled:
+            self.pubsub.start()
+
+    def open(self, category):
+        # returns the room, the key of its host and the number of
+        # questions
+        host_key = secrets.token_urlsafe(16)
+        room = room_id(host_key)
+        question_ids = self.selector.category_ids(category)
+        size = len(question_ids)
+        # the order is a permutation of the range of ids of the category
+        # now, the questions inserted or deleted later don't move it
+        self.store.create(room, category, secrets.randbits(63), size,
+                          *id_range(question_ids))
+        return room, host_key, size
+
+    def next_round(self, room):
+        # the round number and the question of the next round, None when
+        # the quiz is finished. raises KeyError for an unknown or expired
+        # room
+        while True:
+            (category, seed, size, first, span,
+             cursor) = self.store.advance(room)
+            position, question_id = next_in_range(
+                seed, first, span, cursor,
+                self.selector.category_ids(category))
+            if position > cursor:
+                # the skipped positions, read again by no other round
+                self.store.advance(room, position - cursor)
+            if question_id is None:
+                self.close(room)
+                return None
+            # skip the questions deleted since the ids were read
+            question = load_question_row(question_id)
+            if question is not None:
+                break
+        round_number, results = self.store.start_round(room, list(question))
+        self.broadcaster.publish(room, {
+            'type': 'round',
+            'round': round_number,
+            'total_questions': size,
+            'question': public_question(question),
+            'results': results})
+        return round_number, question
+
+    def answer(self, room, player, question_id, answer):
+        # whether the answer is right, None when the question is not the
+        # one of the open round. raises KeyError for an unknown room
+        checked = self.store.answer(room, player, question_id, answer)
+        if checked is None:
+            return None
+        correct, first, category = checked
+        if self.results is not None and first:
+            self.results.record(category,
+                                [(player, question_id, correct, None)])
+        return correct
+
+    def close(self, room):
+        # raises KeyError for an unknown room
+        rounds, results, scoreboard = self.store.close(room)
+        self.broadcaster.publish(room, {'type': 'end', 'rounds': rounds,
+                                        'results': results,
+                                        'scoreboard': scoreboard})
+
+    def stream(self, room):
+        # the Server-Sent Events of the room, raises KeyError for an
+        # unknown room
+        listener = self.broadcaster.listen(room)
+
+        def events():
+            try:
+                # the reconnection delay of EventSource, in milliseconds
+                yield b'retry: 3000\n\n'
+                while True:
+                    try:
+                        chunk = listener.get(timeout=self.heartbeat)
+                    except queue.Empty:
+                        yield b': keepalive\n\n'
+                        continue
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                self.broadcaster.unlisten(room, listener)
+        return events()
+
+    def render(self):
+        return self.broadcaster.render()
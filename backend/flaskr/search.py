@@ -0,0 +1,194 @@
+import re
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import func
+
+from models import db, Question, add_question_listener
+from .pagination import QUESTIONS_PER_PAGE, count_questions
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+'''
+InMemorySearchIndex
+    inverted index of the question text, every token of the search term
+    is matched as a word prefix and the results are ranked by how many
+    times the matched words appear in the question
+'''
+class InMemorySearchIndex:
+
+    def __init__(self):
+        self.postings = {}
+        self.tokens = []
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, question_id, text):
+        with self.lock:
+            self._remove(question_id)
+            counts = {}
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                if token not in self.postings:
+                    self.postings[token] = {}
+                    insort(self.tokens, token)
+                self.postings[token][question_id] = count
+            self.documents[question_id] = list(counts)
+
+    def remove(self, question_id):
+        with self.lock:
+            self._remove(question_id)
+
+    def _remove(self, question_id):
+        for token in self.documents.pop(question_id, []):
+            posting = self.postings[token]
+            del posting[question_id]
+            if not posting:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def _prefix_scores(self, prefix):
+        scores = {}
+        index = bisect_left(self.tokens, prefix)
+        while (index < len(self.tokens) and
+               self.tokens[index].startswith(prefix)):
+            for question_id, count in self.postings[
+                    self.tokens[index]].items():
+                scores[question_id] = scores.get(question_id, 0) + count
+            index += 1
+        return scores
+
+    def search(self, term):
+        terms = tokenize(term)
+        if not terms:
+            return []
+        with self.lock:
+            scores = None
+            for prefix in terms:
+                prefix_scores = self._prefix_scores(prefix)
+                if scores is None:
+                    scores = prefix_scores
+                else:
+                    scores = {question_id: score + prefix_scores[question_id]
+                              for question_id, score in scores.items()
+                              if question_id in prefix_scores}
+                if not scores:
+                    return []
+        return sorted(scores, key=lambda question_id: (-scores[question_id],
+                                                       question_id))
+
+
+'''
+MemorySearchBackend
+    serves the search from an InMemorySearchIndex built from the questions
+    table on first use and kept current by Question.insert()/delete()
+'''
+class MemorySearchBackend:
+
+    def __init__(self):
+        self.index = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.index is None:
+                index = InMemorySearchIndex()
+                rows = db.session.query(Question.id, Question.question)
+                for question_id, text in rows.yield_per(1000):
+                    index.add(question_id, text)
+                self.index = index
+        return self.index
+
+    def question_changed(self, action, question):
+        if self.index is None:
+            return
+        if action == 'insert':
+            self.index.add(question.id, question.question)
+        elif action == 'delete':
+            self.index.remove(question.id)
+        else:
+            # rows were imported in bulk, build the index again on next use
+            self.index = None
+
+    def search(self, term, page):
+        ranked_ids = self.load().search(term)
+        start = (page - 1) * QUESTIONS_PER_PAGE
+        page_ids = ranked_ids[start:start + QUESTIONS_PER_PAGE]
+        if not page_ids:
+            return [], len(ranked_ids)
+        questions = {question.id: question for question in
+                     Question.query.filter(Question.id.in_(page_ids))}
+        return ([questions[question_id] for question_id in page_ids
+                 if question_id in questions], len(ranked_ids))
+
+
+'''
+PostgresSearchBackend
+    matches the search term against the GIN indexed
+    to_tsvector('simple', question) expression of the questions table,
+    ranks with ts_rank and pages in SQL
+'''
+class PostgresSearchBackend:
+
+    def question_changed(self, action, question):
+        # the expression index is maintained by postgres itself
+        pass
+
+    def search(self, term, page):
+        terms = tokenize(term)
+        if not terms:
+            return [], 0
+        vector = func.to_tsvector('simple',
+                                  func.coalesce(Question.question, ''))
+        query = func.to_tsquery('simple', ' & '.join(
+            token + ':*' for token in terms))
+        matches = Question.query.filter(vector.op('@@')(query))
+        total = count_questions(matches)
+        if total == 0:
+            return [], 0
+        questions = matches.order_by(func.ts_rank(vector, query).desc(),
+                                     Question.id)
+        return (questions.offset((page - 1) * QUESTIONS_PER_PAGE)
+                .limit(QUESTIONS_PER_PAGE).all(), total)
+
+
+'''
+QuestionSearch
+    picks the search backend on first use from the SEARCH_BACKEND config,
+    'postgres' or 'memory', defaulting to the dialect of the database
+'''
+class QuestionSearch:
+
+    def __init__(self, app):
+        self.app = app
+        self.backend = None
+        app.extensions['question_search'] = self
+        add_question_listener(app, self.question_changed)
+
+    def get_backend(self):
+        if self.backend is None:
+            name = self.app.config.get('SEARCH_BACKEND')
+            if name is None:
+                postgres = db.engine.dialect.name == 'postgresql'
+                name = 'postgres' if postgres else 'memory'
+            if name == 'postgres':
+                self.backend = PostgresSearchBackend()
+            else:
+                self.backend = MemorySearchBackend()
+        return self.backend
+
+    def question_changed(self, action, question):
+        if self.backend is not None:
+            self.backend.question_changed(action, question)
+
+    def search(self, term, page=1):
+        return self.get_backend().search(term, max(page, 1))
@@ -0,0 +1,78 @@
+from flask.json import JSONEncoder
+
+from models import db, Question
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the columns of Question.format(), selected as plain tuples by the read
+# paths instead of hydrating Question instances
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = tuple(getattr(Question, field)
+                         for field in QUESTION_FIELDS)
+
+
+'''
+question_rows(query)
+    the same query of questions, returning (id, question, answer,
+    category, difficulty) tuples without the ORM identity map
+'''
+def question_rows(query):
+    return query.with_entities(*QUESTION_COLUMNS)
+
+
+def load_question_row(question_id):
+    return db.session.query(*QUESTION_COLUMNS).filter(
+        Question.id == question_id).first()
+
+
+def load_question_rows(question_ids):
+    if not question_ids:
+        return []
+    return db.session.query(*QUESTION_COLUMNS).filter(
+        Question.id.in_(question_ids)).all()
+
+
+'''
+format_row(row)
+    the dict of Question.format() for a row of question_rows()
+'''
+def format_row(row):
+    return dict(zip(QUESTION_FIELDS, row))
+
+
+def format_rows(rows):
+    return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+'''
+columnar(questions)
+    the formatted questions as one array per field, the keys are not
+    repeated for every question
+'''
+def columnar(questions):
+    return {field: [question[field] for question in questions]
+            for field in QUESTION_FIELDS}
+
+
+'''
+FastJSONEncoder
+    the JSON encoder of jsonify, it uses orjson when it's installed and
+    the standard library otherwise (or for indented output)
+'''
+class FastJSONEncoder(JSONEncoder):
+
+    def encode(self, o):
+        if orjson is None or self.indent is not None:
+            return super().encode(o)
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(o, default=self.default,
+                                option=option).decode()
+        except TypeError:
+            # e.g. integers of more than 64 bits
+            return super().encode(o)
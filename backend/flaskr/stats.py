@@ -0,0 +1,69 @@
+from sqlalchemy import func
+
+from models import db, Question
+
+
+'''
+load_question_counts()
+    [category, difficulty, count] of every pair that has questions, in one
+    GROUP BY query
+'''
+def load_question_counts():
+    return [[category, difficulty, count] for category, difficulty, count in
+            db.session.query(Question.category, Question.difficulty,
+                             func.count(Question.id))
+            .group_by(Question.category, Question.difficulty)
+            .order_by(Question.category, Question.difficulty)]
+
+
+'''
+nulls_last(item)
+    sort key of the (key, value) items of a dict whose keys may be None,
+    ordered as the database orders NULL
+'''
+def nulls_last(item):
+    return item[0] is None, item[0] or 0
+
+
+'''
+snapshot_question_counts(snapshot)
+    the same counts from the difficulty buckets of a catalog snapshot, the
+    questions of a deleted category have a None category
+'''
+def snapshot_question_counts(snapshot):
+    return [[category, difficulty, len(ids)]
+            for category, buckets in sorted(snapshot.buckets.items(),
+                                            key=nulls_last)
+            if category != 0
+            for difficulty, ids in sorted(buckets.items(), key=nulls_last)]
+
+
+'''
+summarize_counts(counts, categories)
+    the totals by category, by difficulty and by both of the counts of
+    the [id, type] categories, the categories without questions count 0.
+    the questions without a category or a difficulty only count in the
+    totals they have a key for
+'''
+def summarize_counts(counts, categories):
+    by_category = {category_id: {'type': category_type,
+                                 'total_questions': 0,
+                                 'difficulties': {}}
+                   for category_id, category_type in categories}
+    by_difficulty = {}
+    total = 0
+    for category, difficulty, count in counts:
+        total += count
+        if difficulty is not None:
+            by_difficulty[difficulty] = by_difficulty.get(difficulty,
+                                                          0) + count
+        entry = by_category.get(category)
+        if entry is not None:
+            entry['total_questions'] += count
+            if difficulty is not None:
+                entry['difficulties'][difficulty] = count
+    return {
+        'total_questions': total,
+        'categories': by_category,
+        'difficulties': by_difficulty
+    }
@@ -0,0 +1,219 @@
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from models import db, Question, add_question_listener
+from .metrics import render_counter
+from .search import tokenize
+
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+# characters of a question kept in every key, longer prefixes are checked
+# against the question itself
+SUGGEST_KEY_LENGTH = 24
+
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+
+def start_key(text):
+    return normalize(text)[:SUGGEST_KEY_LENGTH]
+
+
+def word_keys(text):
+    # the normalized text from every word on, cut to SUGGEST_KEY_LENGTH
+    words = tokenize(text)
+    return {' '.join(words[start:])[:SUGGEST_KEY_LENGTH]
+            for start in range(len(words))}
+
+
+'''
+PrefixArray
+    sorted keys and the question id of every key, in a list of strings and
+    a parallel array of integers rather than a list of tuples
+'''
+class PrefixArray:
+
+    def __init__(self, pairs=()):
+        pairs = sorted(pairs)
+        self.keys = [key for key, _ in pairs]
+        self.ids = array('q', [question_id for _, question_id in pairs])
+        self.key_bytes = sum(sys.getsizeof(key) for key in self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, key, question_id):
+        index = bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.ids.insert(index, question_id)
+        self.key_bytes += sys.getsizeof(key)
+
+    def remove(self, key, question_id):
+        index = bisect_left(self.keys, key)
+        while self.ids[index] != question_id:
+            index += 1
+        del self.keys[index]
+        del self.ids[index]
+        self.key_bytes -= sys.getsizeof(key)
+
+    def scan(self, prefix):
+        # the ids of the keys starting with the prefix, in key order
+        index = bisect_left(self.keys, prefix)
+        while (index < len(self.keys) and
+               self.keys[index].startswith(prefix)):
+            yield self.ids[index]
+            index += 1
+
+    def memory_bytes(self):
+        return (sys.getsizeof(self.keys) + sys.getsizeof(self.ids) +
+                self.key_bytes)
+
+
+'''
+SuggestionIndex
+    prefix index of the question text: one key per question from its
+    start, ranked first, and one from every word of the question, so a
+    prefix also matches the start of any of its words. a lookup is a
+    bisect and a scan of the matches.
+'''
+class SuggestionIndex:
+
+    def __init__(self, rows=()):
+        # the (id, question) rows are indexed with one sort
+        self.questions = dict(rows)
+        self.starts = PrefixArray((start_key(text), question_id)
+                                  for question_id, text
+                                  in self.questions.items())
+        self.words = PrefixArray((key, question_id) for question_id, text
+                                 in self.questions.items()
+                                 for key in word_keys(text))
+        self.text_bytes = sum(sys.getsizeof(text)
+                              for text in self.questions.values())
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.questions)
+
+    def add(self, question_id, text):
+        with self.lock:
+            self._remove(question_id)
+            self.questions[question_id] = text
+            self.text_bytes += sys.getsizeof(text)
+            self.starts.insert(start_key(text), question_id)
+            for key in word_keys(text):
+                self.words.insert(key, question_id)
+
+    def remove(self, question_id):
+        with self.lock:
+            self._remove(question_id)
+
+    def _remove(self, question_id):
+        text = self.questions.pop(question_id, None)
+        if text is None:
+            return
+        self.text_bytes -= sys.getsizeof(text)
+        self.starts.remove(start_key(text), question_id)
+        for key in word_keys(text):
+            self.words.remove(key, question_id)
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        # [(id, question)] of the first `limit` questions starting with
+        # the prefix, then of those with a word starting with it
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        key = prefix[:SUGGEST_KEY_LENGTH]
+        found = []
+        seen = set()
+        with self.lock:
+            for keys in (self.starts, self.words):
+                for question_id in keys.scan(key):
+                    if len(found) == limit:
+                        return found
+                    if question_id in seen:
+                        continue
+                    text = self.questions[question_id]
+                    if (len(prefix) > len(key) and
+                            (' ' + normalize(text)).find(' ' + prefix) < 0):
+                        continue
+                    seen.add(question_id)
+                    found.append((question_id, text))
+        return found
+
+    def memory_bytes(self):
+        with self.lock:
+            return (self.starts.memory_bytes() + self.words.memory_bytes() +
+                    sys.getsizeof(self.questions) + self.text_bytes)
+
+
+'''
+Suggestions
+    serves GET /questions/suggest from a SuggestionIndex of the questions
+    table, built on first use (or by wsgi.py before the workers fork) and
+    kept current by Question.insert()/delete() and the bulk imports. the
+    writes of the other workers move the catalog version, the index is
+    then built again in the background and swapped in.
+'''
+class Suggestions:
+
+    def __init__(self, app, watcher):
+        self.watcher = watcher
+        self.index = None
+        self.lock = threading.Lock()
+        app.extensions['suggestions'] = self
+        add_question_listener(app, self.question_changed)
+        watcher.on_change(self.reload)
+
+    def build(self):
+        rows = db.session.query(Question.id, Question.question)
+        return SuggestionIndex(rows.yield_per(1000))
+
+    def load(self):
+        self.watcher.check()
+        with self.lock:
+            if self.index is None:
+                self.index = self.build()
+        return self.index
+
+    def reload(self):
+        # the index of the current rows, swapped in once it's built
+        if self.index is not None:
+            self.index = self.build()
+
+    def question_changed(self, action, question):
+        index = self.index
+        if index is None:
+            return
+        if action == 'insert':
+            index.add(question.id, question.question)
+        elif action == 'delete':
+            index.remove(question.id)
+        elif action == 'import':
+            # the ids of a committed import batch
+            for question_id, text in db.session.query(
+                    Question.id, Question.question).filter(
+                    Question.id.in_(question)):
+                index.add(question_id, text)
+        else:
+            # build the index again on next use
+            self.index = None
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        return self.load().suggest(prefix, limit)
+
+    def render(self):
+        index = self.index
+        lines = []
+        lines += render_counter('trivia_suggest_questions',
+                                'Questions in the suggestion index.',
+                                len(index) if index is not None else 0,
+                                'gauge')
+        lines += render_counter('trivia_suggest_memory_bytes',
+                                'Approximate memory of the suggestion '
+                                'index.',
+                                (index.memory_bytes() if index is not None
+                                 else 0), 'gauge')
+        return '\n'.join(lines) + '\n'
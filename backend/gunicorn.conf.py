@@ -0,0 +1,44 @@
+'''
+gunicorn settings, from the backend folder:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is created once by the master and the workers are forked from
+it, so they start without importing or building anything.
+'''
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+# every client streaming the events of a quiz room holds a thread of a
+# gthread worker (or a greenlet of a gevent one, see worker_connections)
+# until it leaves, a sync worker would serve nothing else
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+preload_app = True
+
+
+def on_starting(server):
+    # the rooms kept in memory are only seen by the worker that opened
+    # them, with more workers they are turned off (POST /rooms is 404)
+    rooms = server.app.wsgi().extensions['rooms']
+    if rooms.enabled and not rooms.shared and server.cfg.workers > 1:
+        rooms.enabled = False
+        server.log.warning(
+            'quiz rooms turned off: rooms in memory need a single worker, '
+            'set ROOM_PUBSUB to redis (with ROOM_REDIS_URL) or '
+            'WEB_CONCURRENCY to 1')
+
+
+def pre_fork(server, worker):
+    # the master may have queried the database while creating the app
+    # (CATALOG), the workers must open their own connections
+    from models import dispose_engines
+    dispose_engines(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    # every worker receives the rounds of the rooms from its first request
+    server.app.wsgi().extensions['rooms'].start()
@@ -0,0 +1,29 @@
+"""full text search index on questions.question
+
+Revision ID: 3f6a1c9d2b7e
+Revises: c5d2f1912276
+Create Date: 2026-10-18 10:12:41.208315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a1c9d2b7e'
+down_revision = 'c5d2f1912276'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the expression must match the one used by flaskr/search.py so the
+    # planner can use the index, postgres keeps it current on every write
+    op.execute(
+        "CREATE INDEX ix_questions_search ON questions "
+        "USING gin (to_tsvector('simple', coalesce(question, '')))"
+    )
+
+
+def downgrade():
+    op.drop_index('ix_questions_search', table_name='questions')
@@ -0,0 +1,50 @@
+"""catalog_version, bumped by triggers on questions and categories
+
+Revision ID: 4c7e9a1b3d2f
+Revises: 8b1e4d2c9a5f
+Create Date: 2026-10-18 19:12:40.281734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c7e9a1b3d2f'
+down_revision = '8b1e4d2c9a5f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('catalog_version',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('version', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+    op.execute("INSERT INTO catalog_version (id, version) VALUES (1, 0)")
+    # one bump per statement, so a COPY of a whole import is one change
+    op.execute("""
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+DECLARE
+  new_version bigint;
+BEGIN
+  UPDATE catalog_version SET version = version + 1 WHERE id = 1
+    RETURNING version INTO new_version;
+  PERFORM pg_notify('trivia_catalog', new_version::text);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+""")
+    for table in ('questions', 'categories'):
+        op.execute(
+            "CREATE TRIGGER {0}_catalog_version "
+            "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {0} "
+            "FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version()"
+            .format(table))
+
+
+def downgrade():
+    op.execute("DROP TRIGGER categories_catalog_version ON categories")
+    op.execute("DROP TRIGGER questions_catalog_version ON questions")
+    op.execute("DROP FUNCTION bump_catalog_version()")
+    op.drop_table('catalog_version')
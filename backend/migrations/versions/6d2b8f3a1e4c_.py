@@ -0,0 +1,44 @@
+"""quiz_results and the leaderboard aggregated from them
+
+Revision ID: 6d2b8f3a1e4c
+Revises: 4c7e9a1b3d2f
+Create Date: 2026-10-18 21:03:17.552190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6d2b8f3a1e4c'
+down_revision = '4c7e9a1b3d2f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('quiz_results',
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('player', sa.String(length=50),
+                              nullable=False),
+                    sa.Column('category', sa.Integer(), nullable=False),
+                    sa.Column('question_id', sa.Integer(), nullable=True),
+                    sa.Column('correct', sa.Boolean(), nullable=False),
+                    sa.Column('answered_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('leaderboard',
+                    sa.Column('category', sa.Integer(), nullable=False),
+                    sa.Column('player', sa.String(length=50),
+                              nullable=False),
+                    sa.Column('answers', sa.Integer(), nullable=False),
+                    sa.Column('correct', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('category', 'player'))
+    op.create_index('ix_leaderboard_category_correct', 'leaderboard',
+                    ['category', 'correct'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_leaderboard_category_correct',
+                  table_name='leaderboard')
+    op.drop_table('leaderboard')
+    op.drop_table('quiz_results')
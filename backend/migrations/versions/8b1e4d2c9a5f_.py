@@ -0,0 +1,49 @@
+"""questions.category as an indexed integer foreign key
+
+Revision ID: 8b1e4d2c9a5f
+Revises: 3f6a1c9d2b7e
+Create Date: 2026-10-18 14:03:22.517904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e4d2c9a5f'
+down_revision = '3f6a1c9d2b7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # values that are not the id of a category can not be converted or
+    # referenced, clear them before changing the type
+    op.execute(
+        "UPDATE questions SET category = NULL WHERE "
+        "CASE WHEN trim(category) ~ '^[0-9]+$' "
+        "THEN trim(category)::integer NOT IN (SELECT id FROM categories) "
+        "ELSE category IS NOT NULL END"
+    )
+    op.alter_column('questions', 'category',
+                    existing_type=sa.String(),
+                    type_=sa.Integer(),
+                    postgresql_using='trim(category)::integer')
+    op.create_foreign_key('questions_category_fkey', 'questions',
+                          'categories', ['category'], ['id'],
+                          ondelete='SET NULL')
+    op.create_index('ix_questions_category_id', 'questions',
+                    ['category', 'id'])
+    op.create_index('ix_questions_category_difficulty', 'questions',
+                    ['category', 'difficulty'])
+
+
+def downgrade():
+    op.drop_index('ix_questions_category_difficulty', table_name='questions')
+    op.drop_index('ix_questions_category_id', table_name='questions')
+    op.drop_constraint('questions_category_fkey', 'questions',
+                       type_='foreignkey')
+    op.alter_column('questions', 'category',
+                    existing_type=sa.Integer(),
+                    type_=sa.String(),
+                    postgresql_using='category::varchar')
@@ -0,0 +1,28 @@
+"""the result token of the quiz results, counted once per question
+
+Revision ID: 9e4a7c2d5b1f
+Revises: 6d2b8f3a1e4c
+Create Date: 2026-10-18 23:41:06.218734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4a7c2d5b1f'
+down_revision = '6d2b8f3a1e4c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('quiz_results',
+                  sa.Column('served', sa.String(length=16), nullable=True))
+    op.create_index('ix_quiz_results_served', 'quiz_results',
+                    ['question_id', 'served'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_quiz_results_served', table_name='quiz_results')
+    op.drop_column('quiz_results', 'served')
@@ -1,24 +1,183 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+import threading
+import time
+from sqlalchemy import Column, String, Integer, BigInteger, Boolean, DateTime, ForeignKey, Index, DDL, create_engine, event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, Pool, QueuePool
+from flask import current_app, has_app_context, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 import json
 
 database_name = "trivia"
 database_path = "postgresql://{}:{}@{}/{}".format('postgres', 'admin', 'localhost:5432', database_name)
+default_database_path = database_path
+
+'''
+RoutingSession
+    sends the queries of GET and HEAD requests to the 'replica' bind when
+    DATABASE_REPLICA_URL is set, everything else goes to the primary
+'''
+class RoutingSession(SignallingSession):
+
+  def get_bind(self, mapper=None, clause=None):
+    if ('replica' in (self.app.config.get('SQLALCHEMY_BINDS') or {}) and
+        has_request_context() and request.method in ('GET', 'HEAD') and
+        not self._flushing):
+      return get_state(self.app).db.get_engine(self.app, bind='replica')
+    return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+
+'''
+PoolMetrics
+    how long the requests waited to check a connection out of the pool,
+    a growing wait means the pool is saturated
+'''
+class PoolMetrics:
+
+  def __init__(self):
+    self.checkouts = 0
+    self.wait_seconds = 0.0
+    self.max_wait_seconds = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, seconds):
+    with self.lock:
+      self.checkouts += 1
+      self.wait_seconds += seconds
+      self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'checkouts': self.checkouts,
+        'wait_seconds': self.wait_seconds,
+        'max_wait_seconds': self.max_wait_seconds
+      }
+
+pool_metrics = PoolMetrics()
+
+class TimedQueuePool(QueuePool):
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      return super()._do_get()
+    finally:
+      pool_metrics.observe(time.perf_counter() - start)
+
+# the value of a setting, from the app config first and then from the
+# environment, None when it's unset or empty
+def setting(app, name, cast=str):
+    value = app.config.get(name, os.environ.get(name))
+    if value is None or value == '':
+        return None
+    if cast is bool and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return cast(value)
+
+'''
+engine_options(app, database_path)
+    builds SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings, read from the
+    app config first and then from the environment:
+      DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds),
+      DB_POOL_RECYCLE (seconds), DB_POOL_PRE_PING,
+      DB_STATEMENT_TIMEOUT (milliseconds) and DB_PGBOUNCER, which leaves
+      the pooling to PgBouncer (set the statement timeout on the database
+      role then, PgBouncer does not forward the startup options)
+'''
+def engine_options(app, database_path):
+    options = {}
+    if make_url(database_path).get_backend_name() != 'postgresql':
+        return options
+    if setting(app, 'DB_PGBOUNCER', bool):
+        options['poolclass'] = NullPool
+        return options
+    options['poolclass'] = TimedQueuePool
+    for name, option, cast in (('DB_POOL_SIZE', 'pool_size', int),
+                               ('DB_MAX_OVERFLOW', 'max_overflow', int),
+                               ('DB_POOL_TIMEOUT', 'pool_timeout', float),
+                               ('DB_POOL_RECYCLE', 'pool_recycle', int),
+                               ('DB_POOL_PRE_PING', 'pool_pre_ping', bool)):
+        value = setting(app, name, cast)
+        if value is not None:
+            options[option] = value
+    statement_timeout = setting(app, 'DB_STATEMENT_TIMEOUT', int)
+    if statement_timeout is not None:
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)}
+    return options
 
-db = SQLAlchemy()
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, the database is
+    database_path, or DATABASE_URL from the app config or the environment.
+    DATABASE_REPLICA_URL adds a read replica used by the GET requests.
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = setting(app, 'DATABASE_URL') or default_database_path
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app, database_path)
+    replica_path = setting(app, 'DATABASE_REPLICA_URL')
+    if replica_path:
+        app.config["SQLALCHEMY_BINDS"] = {'replica': replica_path}
     db.app = app
     db.init_app(app)
     #db.create_all()
-    Migrate(app, db)
+    # the migration commands are only used through the flask command,
+    # alembic is slow to import in every worker
+    if setting(app, 'FLASK_RUN_FROM_CLI', bool):
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+'''
+dispose_engines(app)
+    closes the pooled connections of the app engines, so a process that
+    used the database before forking (gunicorn --preload) does not share
+    its connections with the workers
+'''
+def dispose_engines(app):
+    binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+    with app.app_context():
+        for bind in binds:
+            db.get_engine(app, bind=bind).dispose()
+
+@event.listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(Pool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection inherited through a fork is left to the parent, the
+    # pool opens a new one for this process
+    pid = connection_record.info.get('pid', os.getpid())
+    if pid != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'connection opened by process {}'.format(pid))
+
+'''
+add_question_listener(app, listener)
+    registers listener(action, question) to be called after a question
+    of this app is committed, action is 'insert' or 'delete', 'import'
+    with the ids of a batch of rows committed by the bulk import, or
+    'bulk' with no question after other changes of many rows
+'''
+def add_question_listener(app, listener):
+    app.extensions.setdefault('question_listeners', []).append(listener)
+
+def question_changed(action, question):
+    if not has_app_context():
+        return
+    for listener in current_app.extensions.get('question_listeners', []):
+        listener(action, question)
 
 '''
 Question
@@ -30,8 +189,15 @@ class Question(db.Model):
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', ondelete='SET NULL'))
   difficulty = Column(Integer)
+
+  # (category, id) serves the paginated category listings and
+  # (category, difficulty) the quiz draws
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+    Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+  )
   
   def __init__(self, question, answer, category, difficulty):
     self.question = question
@@ -42,6 +208,7 @@ class Question(db.Model):
   def insert(self):
     db.session.add(self)
     db.session.commit()
+    question_changed('insert', self)
   
   def update(self):
     db.session.commit()
@@ -49,6 +216,7 @@ class Question(db.Model):
   def delete(self):
     db.session.delete(self)
     db.session.commit()
+    question_changed('delete', self)
 
   def format(self):
     return {
@@ -59,6 +227,13 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+# the full text search index of flaskr/search.py, also created by the
+# migrations, postgres only
+event.listen(Question.__table__, 'after_create', DDL(
+  "CREATE INDEX ix_questions_search ON questions "
+  "USING gin (to_tsvector('simple', coalesce(question, '')))"
+).execute_if(dialect='postgresql'))
+
 '''
 Category
 
@@ -76,4 +251,96 @@ class Category(db.Model):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+CatalogVersion
+    a single row counting the changes of questions and categories, on
+    postgres it's bumped by a trigger that also notifies the
+    'trivia_catalog' channel, flaskr/catalog.py polls or listens to it
+'''
+class CatalogVersion(db.Model):
+  __tablename__ = 'catalog_version'
+
+  id = Column(Integer, primary_key=True)
+  version = Column(BigInteger, nullable=False, default=0)
+
+'''
+QuizResult
+    one answer of a quiz player, 0 is the category of the quizzes of all
+    the categories. written in batches by flaskr/results.py, it's a log:
+    the question may have been deleted since.
+'''
+class QuizResult(db.Model):
+  __tablename__ = 'quiz_results'
+
+  id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+  player = Column(String(50), nullable=False)
+  category = Column(Integer, nullable=False)
+  question_id = Column(Integer)
+  correct = Column(Boolean, nullable=False)
+  answered_at = Column(DateTime, nullable=False)
+  # the nonce of the result token, a token counts once per question
+  served = Column(String(16))
+
+  __table_args__ = (
+    Index('ix_quiz_results_served', 'question_id', 'served', unique=True),
+  )
+
+'''
+LeaderboardEntry
+    the answers and the right answers of a player in a category, added to
+    by every flush of the quiz results so the leaderboard never reads them
+'''
+class LeaderboardEntry(db.Model):
+  __tablename__ = 'leaderboard'
+
+  category = Column(Integer, primary_key=True)
+  player = Column(String(50), primary_key=True)
+  answers = Column(Integer, nullable=False, default=0)
+  correct = Column(Integer, nullable=False, default=0)
+
+  __table_args__ = (
+    Index('ix_leaderboard_category_correct', 'category', 'correct'),
+  )
+
+catalog_triggers = """
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+DECLARE
+  new_version bigint;
+BEGIN
+  UPDATE catalog_version SET version = version + 1 WHERE id = 1
+    RETURNING version INTO new_version;
+  PERFORM pg_notify('trivia_catalog', new_version::text);
+  RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS questions_catalog_version ON questions;
+CREATE TRIGGER questions_catalog_version
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON questions
+  FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+DROP TRIGGER IF EXISTS categories_catalog_version ON categories;
+CREATE TRIGGER categories_catalog_version
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON categories
+  FOR EACH STATEMENT EXECUTE PROCEDURE bump_catalog_version();
+"""
+
+# also created by the migrations, the triggers are replaced when
+# create_all() runs on an existing database. sqlite has no statement
+# triggers nor NOTIFY, its row triggers only move the version
+event.listen(CatalogVersion.__table__, 'after_create', DDL(
+  "INSERT INTO catalog_version (id, version) VALUES (1, 0)"))
+event.listen(db.Model.metadata, 'after_create', DDL(
+  catalog_triggers).execute_if(dialect='postgresql'))
+def listen_sqlite_trigger(table, operation):
+  name = '{}_catalog_version_{}'.format(table, operation.lower())
+  event.listen(db.Model.metadata, 'after_create', DDL(
+    'DROP TRIGGER IF EXISTS ' + name).execute_if(dialect='sqlite'))
+  event.listen(db.Model.metadata, 'after_create', DDL(
+    'CREATE TRIGGER {} AFTER {} ON {} BEGIN UPDATE catalog_version '
+    'SET version = version + 1 WHERE id = 1; END'.format(
+      name, operation, table)).execute_if(dialect='sqlite'))
+
+for table in ('questions', 'categories'):
+  for operation in ('INSERT', 'UPDATE', 'DELETE'):
+    listen_sqlite_trigger(table, operation)
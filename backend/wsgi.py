@@ -0,0 +1,16 @@
+'''
+The application of the WSGI servers, see gunicorn.conf.py.
+'''
+from flaskr import create_app
+
+app = create_app()
+
+# built once here, the workers forked by gunicorn --preload share them
+try:
+    with app.app_context():
+        app.extensions['catalog_watcher'].start()
+        app.extensions['suggestions'].load()
+        app.extensions['dedupe'].load()
+except Exception:
+    app.logger.exception('indexes not loaded, they will be on the first '
+                         'request')